@@ -0,0 +1,225 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# PutMetricData accepts up to 1000 datapoints and 1MB of payload per request.
+MAX_METRICS_PER_CALL = int(os.environ.get("MAX_METRICS_PER_CALL", 1000))
+MAX_PAYLOAD_BYTES = int(os.environ.get("MAX_PAYLOAD_BYTES", 900 * 1024))
+PUBLISH_WORKERS = int(os.environ.get("PUBLISH_WORKERS", 4))
+MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 6))
+BACKOFF_BASE = float(os.environ.get("BACKOFF_BASE", 0.1))
+BACKOFF_CAP = float(os.environ.get("BACKOFF_CAP", 5))
+
+THROTTLING_CODES = set([
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "SlowDown",
+    "ServiceUnavailable",
+])
+TOO_LARGE_CODES = set([
+    "RequestEntityTooLarge",
+    "413",
+])
+
+# boto3 clients and resources by service name, created on first use and kept
+# while the Lambda container stays warm. boto3 itself is only imported then, so
+# importing a handler stays cheap and code paths that never call a service
+# don't pay to set up its client.
+clients = {}
+resources = {}
+clientLock = threading.Lock()
+
+
+def getClient(service):
+    """Returns the shared boto3 client for service, creating it on first use."""
+    return cached(clients, service, "client")
+
+
+def getResource(service):
+    """Returns the shared boto3 service resource, creating it on first use."""
+    return cached(resources, service, "resource")
+
+
+def cached(cache, service, factory):
+    value = cache.get(service)
+    if value is None:
+        # Creating clients from boto3's default session isn't thread safe
+        with clientLock:
+            value = cache.get(service)
+            if value is None:
+                import boto3
+                value = cache[service] = getattr(boto3, factory)(service)
+    return value
+
+
+def errorCode(e):
+    """
+    Returns the AWS error code of a botocore ClientError, or None for any
+    other exception.
+    """
+    response = getattr(e, "response", None) or {}
+    code = response.get("Error", {}).get("Code")
+    if code is None and response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 413:
+        return "413"
+    return code
+
+
+def isThrottlingError(e):
+    return errorCode(e) in THROTTLING_CODES
+
+
+def backoffDelay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def callWithBackoff(fn, *args, **kwargs):
+    """
+    Calls fn, retrying throttled requests with jittered exponential backoff.
+    Any other error, or a throttling error after MAX_RETRIES retries, is
+    raised to the caller.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not isThrottlingError(e) or attempt >= MAX_RETRIES:
+                raise
+            time.sleep(backoffDelay(attempt))
+            attempt += 1
+
+
+def estimateSize(value):
+    """
+    Rough size of a value once query-encoded for the AWS API, where every leaf
+    carries its full member path (e.g. MetricData.member.12.Values.member.3=).
+    Errs on the large side.
+    """
+    if isinstance(value, dict):
+        return sum(len(k) + estimateSize(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(estimateSize(v) for v in value)
+    return 48 + len(str(value))
+
+
+class MetricPublisher(object):
+    """
+    Publishes metric data with put_metric_data. Datapoints are gathered into
+    requests of up to MAX_METRICS_PER_CALL datapoints and MAX_PAYLOAD_BYTES,
+    which are sent concurrently over a bounded thread pool. Throttled requests
+    are retried with jittered exponential backoff, and requests rejected as too
+    large are split in half and resent. flush() waits for every request and
+    reports calls, failures and publish latency.
+    """
+    def __init__(self, client, namespace, batchSize=MAX_METRICS_PER_CALL,
+                 maxPayload=MAX_PAYLOAD_BYTES, workers=PUBLISH_WORKERS):
+        self.client = client
+        self.namespace = namespace
+        self.batchSize = batchSize
+        self.maxPayload = maxPayload
+        self.workers = workers
+        self.executor = None
+        self.futures = []
+        self.metricData = []
+        self.pendingSize = 0
+        self.calls = 0
+        self.metrics = 0
+        self.retries = 0
+        self.failures = 0
+        self.failedMetrics = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def append(self, datum):
+        size = estimateSize(datum)
+        if self.metricData and self.pendingSize + size > self.maxPayload:
+            self.send()
+        self.metricData.append(datum)
+        self.pendingSize += size
+        if len(self.metricData) >= self.batchSize:
+            self.send()
+
+    def extend(self, metricData):
+        for datum in metricData:
+            self.append(datum)
+
+    def send(self):
+        if not self.metricData:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.futures.append(self.executor.submit(self.put, self.metricData))
+        self.metricData = []
+        self.pendingSize = 0
+
+    def put(self, metricData):
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                self.client.put_metric_data(
+                    Namespace=self.namespace,
+                    MetricData=metricData
+                )
+            except Exception as e:
+                self.record(start)
+                if errorCode(e) in TOO_LARGE_CODES and len(metricData) > 1:
+                    middle = len(metricData) // 2
+                    self.put(metricData[:middle])
+                    self.put(metricData[middle:])
+                    return
+                if isThrottlingError(e) and attempt < MAX_RETRIES:
+                    self.record(retries=1)
+                    time.sleep(backoffDelay(attempt))
+                    attempt += 1
+                    continue
+                self.record(failures=1, failedMetrics=len(metricData))
+                logger.error("Failed to publish %s metrics to %s: %s",
+                             len(metricData), self.namespace, e)
+                return
+            self.record(start, calls=1, metrics=len(metricData))
+            return
+
+    def record(self, start=None, **counters):
+        with self.lock:
+            if start is not None:
+                self.latencies.append(time.time() - start)
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def flush(self):
+        self.send()
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        latencies = sorted(self.latencies)
+        result = {
+            "calls": self.calls,
+            "metrics": self.metrics,
+            "retries": self.retries,
+            "failures": self.failures,
+            "failedMetrics": self.failedMetrics,
+            "maxLatencyMs": latencies[-1] * 1000 if latencies else 0,
+            "avgLatencyMs": sum(latencies) / len(latencies) * 1000 if latencies else 0,
+        }
+        logger.info("Sent %(calls)s put_metric_data calls (%(metrics)s metrics, "
+                    "%(retries)s retries, %(failures)s failed), "
+                    "latency avg %(avgLatencyMs).0fms max %(maxLatencyMs).0fms",
+                    result)
+        return result
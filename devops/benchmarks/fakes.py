@@ -0,0 +1,651 @@
+"""
+In-process stand-ins for the services the devops scripts talk to, for use by
+the offline benchmarks. Nothing here talks to AWS, geth or Kafka.
+
+Every fake AWS client counts its calls per operation and can be given a
+per-call latency and a throttling rate, raising errors shaped like botocore's
+ClientError so awsUtils' retry logic sees them as it would in production.
+install() puts a boto3 module in sys.modules whose client() and resource()
+return the shared fakes, so the Lambda modules run unchanged.
+
+FakeGeth serves JSON-RPC (including batches and eth_subscribe notifications)
+on a Unix socket, and InMemoryKafka provides the parts of kafka-python that
+peerManager uses.
+"""
+
+import collections
+import datetime
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import types
+
+
+class FakeClientError(Exception):
+    """Looks enough like botocore's ClientError for awsUtils.errorCode"""
+    def __init__(self, code, operation, message=""):
+        Exception.__init__(self, "An error occurred (%s) when calling the %s operation: %s" % (
+            code, operation, message))
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+class FakePaginator(object):
+    def __init__(self, method, tokenName="NextToken"):
+        self.method = method
+        self.tokenName = tokenName
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            if token:
+                kwargs[self.tokenName] = token
+            page = self.method(**kwargs)
+            yield page
+            token = page.get(self.tokenName)
+            if not token:
+                return
+
+
+class FakeService(object):
+    """
+    Base for the fake clients. Operations call self.call(name) first, which
+    counts the request, sleeps for `latency` seconds and throttles a
+    `throttleRate` fraction of requests. Like botocore, throttled requests are
+    retried up to `retries` times with jittered backoff before the error
+    reaches the caller.
+    """
+    paginated = {}
+    throttleCode = "Throttling"
+
+    def __init__(self, latency=0, throttleRate=0, seed=0, retries=4, backoff=0.05):
+        self.latency = latency
+        self.throttleRate = throttleRate
+        self.retries = retries
+        self.backoff = backoff
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.throttled = 0
+
+    def call(self, operation):
+        for attempt in range(self.retries + 1):
+            with self.lock:
+                self.calls[operation] += 1
+                throttle = self.throttleRate and self.random.random() < self.throttleRate
+                if throttle:
+                    self.throttled += 1
+                delay = self.random.uniform(0, self.backoff * 2 ** attempt)
+            if self.latency:
+                time.sleep(self.latency)
+            if not throttle:
+                return
+            if attempt < self.retries:
+                time.sleep(delay)
+        raise FakeClientError(self.throttleCode, operation, "Rate exceeded")
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation), self.paginated.get(operation, "NextToken"))
+
+    def page(self, items, NextToken=None, MaxResults=None, default=1000):
+        start = int(NextToken or 0)
+        end = start + (MaxResults or default)
+        return items[start:end], (str(end) if end < len(items) else None)
+
+
+def matchesFilters(item, filters):
+    for f in filters or []:
+        name = f["Name"]
+        if name.startswith("tag:"):
+            tags = dict((t["Key"], t["Value"]) for t in item.get("Tags", []))
+            value = tags.get(name[4:])
+        elif name == "volume-id":
+            value = item.get("VolumeId")
+        elif name == "attachment.device":
+            devices = [a.get("Device") for a in item.get("Attachments", [])]
+            if not set(devices) & set(f["Values"]):
+                return False
+            continue
+        else:
+            value = item.get(name)
+        if value not in f["Values"]:
+            return False
+    return True
+
+
+class FakeCloudWatch(FakeService):
+    def __init__(self, metricValues=None, **kwargs):
+        FakeService.__init__(self, **kwargs)
+        self.metrics = 0
+        # Values returned by get_metric_data, by query label
+        self.metricValues = metricValues or {}
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.call("PutMetricData")
+        if len(MetricData) > 1000:
+            raise FakeClientError("InvalidParameterValue", "PutMetricData",
+                                  "At most 1000 datums per request")
+        with self.lock:
+            self.metrics += len(MetricData)
+        return {}
+
+    def get_metric_data(self, MetricDataQueries, **kwargs):
+        self.call("GetMetricData")
+        return {"MetricDataResults": [{
+            "Id": q["Id"],
+            "Label": q.get("Label"),
+            "Values": [self.metricValues[q.get("Label")]] if q.get("Label") in self.metricValues else [],
+        } for q in MetricDataQueries]}
+
+
+class FakeSNS(FakeService):
+    def __init__(self, **kwargs):
+        FakeService.__init__(self, **kwargs)
+        self.messages = []
+
+    def publish(self, TopicArn, Subject, Message):
+        self.call("Publish")
+        self.messages.append((TopicArn, Subject, Message))
+        return {"MessageId": str(len(self.messages))}
+
+
+class FakeSSM(FakeService):
+    def __init__(self, **kwargs):
+        FakeService.__init__(self, **kwargs)
+        self.parameters = {}
+        self.commands = []
+
+    def get_parameter(self, Name):
+        self.call("GetParameter")
+        if Name not in self.parameters:
+            raise FakeClientError("ParameterNotFound", "GetParameter")
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name]}}
+
+    def put_parameter(self, Name, Value, Type="String", Overwrite=False):
+        self.call("PutParameter")
+        self.parameters[Name] = Value
+        return {"Version": 1}
+
+    def send_command(self, InstanceIds, DocumentName, Parameters):
+        self.call("SendCommand")
+        self.commands.append((InstanceIds, DocumentName, Parameters))
+        return {"Command": {"CommandId": str(len(self.commands))}}
+
+
+class FakeEC2(FakeService):
+    """
+    Snapshots, volumes, instances and subnets held in dicts. Detached volumes
+    become available `detachDelay` seconds after detach_volume, and create_fleet
+    / create_instances fail with InsufficientInstanceCapacity for any
+    (availability zone, instance type) pair in `noCapacity`.
+    """
+    throttleCode = "RequestLimitExceeded"
+
+    def __init__(self, detachDelay=0, noCapacity=(), **kwargs):
+        FakeService.__init__(self, **kwargs)
+        self.snapshots = collections.OrderedDict()
+        self.volumes = collections.OrderedDict()
+        self.modifications = []
+        self.instances = {}
+        self.subnets = {}
+        self.detachDelay = detachDelay
+        self.noCapacity = set(noCapacity)
+        self.ids = itertools.count(1)
+
+    def addSnapshot(self, snapshotId, startTime, progress="100%", tags=None):
+        self.snapshots[snapshotId] = {
+            "SnapshotId": snapshotId,
+            "StartTime": startTime,
+            "Progress": progress,
+            "State": "completed" if progress == "100%" else "pending",
+            "Tags": [{"Key": k, "Value": v} for k, v in (tags or {}).items()],
+        }
+
+    def addVolume(self, volumeId, size=1000, instanceId=None, device="/dev/sdf", tags=None):
+        self.volumes[volumeId] = {
+            "VolumeId": volumeId,
+            "Size": size,
+            "State": "in-use" if instanceId else "available",
+            "Attachments": [{"InstanceId": instanceId, "Device": device, "State": "attached"}] if instanceId else [],
+            "Tags": [{"Key": k, "Value": v} for k, v in (tags or {}).items()],
+        }
+
+    def addInstance(self, instanceId, instanceType="r5d.large", tags=None, volumes=None):
+        self.instances[instanceId] = {
+            "InstanceId": instanceId,
+            "InstanceType": instanceType,
+            "PrivateDnsName": "ip-10-0-%d-%d.ec2.internal" % (len(self.instances) // 256, len(self.instances) % 256),
+            "Tags": [{"Key": k, "Value": v} for k, v in (tags or {}).items()],
+            "BlockDeviceMappings": [{"DeviceName": device, "Ebs": {"VolumeId": volumeId}}
+                                    for device, volumeId in (volumes or {}).items()],
+        }
+
+    def describe_snapshots(self, SnapshotIds=None, Filters=None, NextToken=None, MaxResults=None, OwnerIds=None):
+        self.call("DescribeSnapshots")
+        if SnapshotIds:
+            missing = [i for i in SnapshotIds if i not in self.snapshots]
+            if missing:
+                raise FakeClientError("InvalidSnapshot.NotFound", "DescribeSnapshots", str(missing))
+            return {"Snapshots": [self.snapshots[i] for i in SnapshotIds]}
+        with self.lock:
+            items = [s for s in self.snapshots.values() if matchesFilters(s, Filters)]
+        page, token = self.page(items, NextToken, MaxResults)
+        return {"Snapshots": page, "NextToken": token}
+
+    def delete_snapshot(self, SnapshotId):
+        self.call("DeleteSnapshot")
+        with self.lock:
+            if self.snapshots.pop(SnapshotId, None) is None:
+                raise FakeClientError("InvalidSnapshot.NotFound", "DeleteSnapshot")
+        return {}
+
+    def refreshVolumes(self):
+        now = time.time()
+        for volume in self.volumes.values():
+            if volume.get("DetachedAt") and volume["DetachedAt"] <= now:
+                volume["State"] = "available"
+                volume["Attachments"] = []
+                del volume["DetachedAt"]
+
+    def describe_volumes(self, VolumeIds=None, Filters=None, NextToken=None, MaxResults=None):
+        self.call("DescribeVolumes")
+        with self.lock:
+            self.refreshVolumes()
+            items = [self.volumes[i] for i in VolumeIds] if VolumeIds else list(self.volumes.values())
+            items = [v for v in items if matchesFilters(v, Filters)]
+        page, token = self.page(items, NextToken, MaxResults, 500)
+        return {"Volumes": page, "NextToken": token}
+
+    def delete_volume(self, VolumeId):
+        self.call("DeleteVolume")
+        with self.lock:
+            self.refreshVolumes()
+            volume = self.volumes.get(VolumeId)
+            if volume is None:
+                raise FakeClientError("InvalidVolume.NotFound", "DeleteVolume")
+            if volume["State"] != "available":
+                raise FakeClientError("VolumeInUse", "DeleteVolume")
+            del self.volumes[VolumeId]
+        return {}
+
+    def detach_volume(self, VolumeId, InstanceId=None, Device=None):
+        self.call("DetachVolume")
+        with self.lock:
+            self.volumes[VolumeId]["State"] = "in-use"
+            self.volumes[VolumeId]["DetachedAt"] = time.time() + self.detachDelay
+        return {"State": "detaching"}
+
+    def create_tags(self, Resources, Tags):
+        self.call("CreateTags")
+        with self.lock:
+            for resource in Resources:
+                item = self.volumes.get(resource) or self.snapshots.get(resource) or self.instances.get(resource)
+                tags = dict((t["Key"], t["Value"]) for t in item.get("Tags", []))
+                tags.update((t["Key"], t["Value"]) for t in Tags)
+                item["Tags"] = [{"Key": k, "Value": v} for k, v in tags.items()]
+        return {}
+
+    def modify_volume(self, VolumeId, Size):
+        self.call("ModifyVolume")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self.lock:
+            volume = self.volumes[VolumeId]
+            self.modifications.append({
+                "VolumeId": VolumeId,
+                "ModificationState": "optimizing",
+                "OriginalSize": volume["Size"],
+                "TargetSize": Size,
+                "StartTime": now,
+            })
+            volume["Size"] = Size
+        return {"VolumeModification": self.modifications[-1]}
+
+    def describe_volumes_modifications(self, VolumeIds=None, Filters=None, NextToken=None, MaxResults=None):
+        self.call("DescribeVolumesModifications")
+        # Like EC2, listing a volume that was never modified fails the call
+        # rather than leaving it out.
+        modified = set(m["VolumeId"] for m in self.modifications)
+        missing = [i for i in VolumeIds or [] if i not in modified]
+        if missing:
+            raise FakeClientError("InvalidVolumeModification.NotFound",
+                                  "DescribeVolumesModifications", str(missing))
+        items = [m for m in self.modifications
+                 if (not VolumeIds or m["VolumeId"] in VolumeIds) and matchesFilters(m, Filters)]
+        page, token = self.page(items, NextToken, MaxResults, 500)
+        return {"VolumesModifications": page, "NextToken": token}
+
+    def describe_instances(self, InstanceIds=None):
+        self.call("DescribeInstances")
+        return {"Reservations": [{"Instances": [self.instances[i] for i in InstanceIds or self.instances]}]}
+
+    def describe_subnets(self, SubnetIds=None):
+        self.call("DescribeSubnets")
+        return {"Subnets": [{"SubnetId": i, "AvailabilityZone": self.subnets[i]} for i in SubnetIds or self.subnets]}
+
+    def launch(self, instanceType, subnetId):
+        if (self.subnets.get(subnetId), instanceType) in self.noCapacity:
+            return None
+        instanceId = "i-%012d" % next(self.ids)
+        self.addInstance(instanceId, instanceType)
+        return instanceId
+
+    def create_fleet(self, Type, TargetCapacitySpecification, LaunchTemplateConfigs, SpotOptions=None):
+        self.call("CreateFleet")
+        errors = []
+        overrides = sorted(LaunchTemplateConfigs[0]["Overrides"], key=lambda o: o.get("Priority", 0))
+        for override in overrides:
+            zone = self.subnets.get(override["SubnetId"])
+            instanceId = self.launch(override["InstanceType"], override["SubnetId"])
+            details = {"LaunchTemplateAndOverrides": {"Overrides": dict(override, AvailabilityZone=zone)}}
+            if instanceId is None:
+                errors.append(dict(details, ErrorCode="InsufficientInstanceCapacity",
+                                   ErrorMessage="There is no Spot capacity available"))
+                continue
+            return {"Errors": errors, "Instances": [dict(
+                details, InstanceIds=[instanceId], InstanceType=override["InstanceType"])]}
+        return {"Errors": errors, "Instances": []}
+
+
+class FakeEC2Resource(object):
+    """The slice of boto3's EC2 ServiceResource that getSnapshot uses"""
+    def __init__(self, client):
+        self.meta = types.SimpleNamespace(client=client)
+
+    def create_instances(self, InstanceType, SubnetId, **kwargs):
+        self.meta.client.call("RunInstances")
+        instanceId = self.meta.client.launch(InstanceType, SubnetId)
+        if instanceId is None:
+            raise FakeClientError("InsufficientInstanceCapacity", "RunInstances")
+        return [types.SimpleNamespace(id=instanceId)]
+
+
+class FakeTagging(FakeService):
+    """Resource Groups Tagging API over a FakeEC2's volumes"""
+    paginated = {"get_resources": "PaginationToken"}
+
+    def __init__(self, ec2, **kwargs):
+        FakeService.__init__(self, **kwargs)
+        self.ec2 = ec2
+
+    def get_resources(self, TagFilters=None, ResourceTypeFilters=None, PaginationToken=None, ResourcesPerPage=None):
+        self.call("GetResources")
+        filters = [{"Name": "tag:" + f["Key"], "Values": f["Values"]} for f in TagFilters or []]
+        with self.ec2.lock:
+            items = [{"ResourceARN": "arn:aws:ec2:us-east-1:123456789012:volume/" + v["VolumeId"],
+                      "Tags": v["Tags"]}
+                     for v in self.ec2.volumes.values() if matchesFilters(v, filters)]
+        page, token = self.page(items, PaginationToken, ResourcesPerPage, 100)
+        return {"ResourceTagMappingList": page, "PaginationToken": token or ""}
+
+
+class FakeAWS(object):
+    """One of each fake client, sharing state the way the real services do"""
+    def __init__(self, latency=0, throttleRate=0, seed=0, **ec2Options):
+        options = {"latency": latency, "throttleRate": throttleRate, "seed": seed}
+        self.cloudwatch = FakeCloudWatch(**options)
+        self.ec2 = FakeEC2(**dict(options, **ec2Options))
+        self.sns = FakeSNS(**options)
+        self.ssm = FakeSSM(**options)
+        self.tagging = FakeTagging(self.ec2, **options)
+        self.clients = {
+            "cloudwatch": self.cloudwatch,
+            "ec2": self.ec2,
+            "sns": self.sns,
+            "ssm": self.ssm,
+            "resourcegroupstaggingapi": self.tagging,
+        }
+        # Calls to the non-AWS stand-ins (geth, HTTP providers), by "service.method"
+        self.external = collections.Counter()
+
+    def calls(self):
+        total = collections.Counter()
+        for name, client in self.clients.items():
+            for operation, count in client.calls.items():
+                total["%s.%s" % (name, operation)] += count
+        total.update(self.external)
+        return dict(total)
+
+    def throttled(self):
+        return sum(client.throttled for client in self.clients.values())
+
+
+current = FakeAWS()
+
+
+def install():
+    """
+    Makes `import boto3` return a module whose client() and resource() return
+    the fakes of `current` at the time they are called. To switch to a fresh
+    FakeAWS, assign it to `current` and clear awsUtils' client caches.
+    """
+    module = types.ModuleType("boto3")
+    module.client = lambda name, *args, **kwargs: current.clients[name]
+    module.resource = lambda name, *args, **kwargs: FakeEC2Resource(current.ec2)
+    sys.modules["boto3"] = module
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    return module
+
+
+class FakeGeth(object):
+    """
+    A JSON-RPC server on a Unix socket. `methods` maps method names to
+    functions of the params returning the result; unknown methods get a
+    method-not-found error. eth_subscribe is handled here: notify(kind, result)
+    sends a notification to every subscriber of that kind.
+    """
+    def __init__(self, path, methods, latency=0):
+        self.path = path
+        self.methods = methods
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.requests = 0
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX)
+        self.server.bind(path)
+        self.server.listen(16)
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, conn):
+        decoder = json.JSONDecoder()
+        sendLock = threading.Lock()
+        buffer = ""
+        while True:
+            try:
+                data = conn.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data.decode("utf8")
+            while buffer.strip():
+                try:
+                    payload, end = decoder.raw_decode(buffer.lstrip())
+                except ValueError:
+                    break
+                buffer = buffer.lstrip()[end:]
+                with self.lock:
+                    self.requests += 1
+                if self.latency:
+                    time.sleep(self.latency)
+                if isinstance(payload, list):
+                    response = [self.handle(r, conn, sendLock) for r in payload]
+                else:
+                    response = self.handle(payload, conn, sendLock)
+                try:
+                    with sendLock:
+                        conn.sendall(json.dumps(response).encode("utf8"))
+                except OSError:
+                    return
+
+    def handle(self, request, conn, sendLock):
+        method = request.get("method")
+        with self.lock:
+            self.calls[method] += 1
+        if method == "eth_subscribe":
+            subscriptionId = "0x%x" % (len(self.subscriptions) + 1)
+            with self.lock:
+                self.subscriptions.append((request["params"][0], subscriptionId, conn, sendLock))
+            return {"jsonrpc": "2.0", "id": request["id"], "result": subscriptionId}
+        if method not in self.methods:
+            return {"jsonrpc": "2.0", "id": request["id"],
+                    "error": {"code": -32601, "message": "the method %s does not exist" % method}}
+        return {"jsonrpc": "2.0", "id": request["id"],
+                "result": self.methods[method](*request.get("params", []))}
+
+    def notify(self, kind, result):
+        for subscriptionKind, subscriptionId, conn, sendLock in list(self.subscriptions):
+            if subscriptionKind != kind:
+                continue
+            message = {"jsonrpc": "2.0", "method": "eth_subscription",
+                       "params": {"subscription": subscriptionId, "result": result}}
+            try:
+                with sendLock:
+                    conn.sendall(json.dumps(message).encode("utf8"))
+            except OSError:
+                pass
+
+    def close(self):
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class InMemoryKafka(object):
+    """
+    Topics held as lists of records, with the subset of kafka-python's API
+    peerManager uses. module() returns an object to install as sys.modules
+    ["kafka"]. Compacted topics keep only the latest record per key when
+    compact() is called.
+    """
+    Record = collections.namedtuple("Record", ["key", "value", "timestamp", "offset"])
+
+    def __init__(self):
+        self.topics = collections.defaultdict(list)
+        self.configs = {}
+        self.lock = threading.Lock()
+
+    def append(self, topic, value, key=None, timestamp=None):
+        with self.lock:
+            log = self.topics[topic]
+            log.append(self.Record(key, value, int((timestamp or time.time()) * 1000), len(log)))
+
+    def compact(self, topic):
+        with self.lock:
+            latest = {}
+            for record in self.topics[topic]:
+                latest[record.key if record.key is not None else ("offset", record.offset)] = record
+            self.topics[topic] = [r for r in sorted(latest.values(), key=lambda r: r.offset)
+                                  if r.value is not None or r.key is None]
+
+    def module(self):
+        kafka = self
+        module = types.ModuleType("kafka")
+        errors = types.ModuleType("kafka.errors")
+        admin = types.ModuleType("kafka.admin")
+
+        class TopicAlreadyExistsError(Exception):
+            pass
+        errors.TopicAlreadyExistsError = TopicAlreadyExistsError
+
+        class NewTopic(object):
+            def __init__(self, name, num_partitions, replication_factor, topic_configs=None):
+                self.name = name
+                self.topic_configs = topic_configs or {}
+
+        class ConfigResource(object):
+            def __init__(self, resource_type, name, configs=None):
+                self.name = name
+                self.configs = configs or {}
+
+        admin.NewTopic = NewTopic
+        admin.ConfigResource = ConfigResource
+        admin.ConfigResourceType = types.SimpleNamespace(TOPIC=2)
+
+        class KafkaAdminClient(object):
+            def __init__(self, **config):
+                pass
+
+            def create_topics(self, topics):
+                for topic in topics:
+                    with kafka.lock:
+                        if topic.name in kafka.configs:
+                            raise TopicAlreadyExistsError(topic.name)
+                        kafka.configs[topic.name] = dict(topic.topic_configs)
+
+            def alter_configs(self, resources):
+                for resource in resources:
+                    kafka.configs[resource.name] = dict(resource.configs)
+
+            def close(self):
+                pass
+
+        class KafkaConsumer(object):
+            def __init__(self, topic, auto_offset_reset="earliest", **config):
+                self.topic = topic
+                self.position_ = 0
+                self.assigned = False
+
+            def assignment(self):
+                return set([(self.topic, 0)]) if self.assigned else set()
+
+            def end_offsets(self, partitions):
+                with kafka.lock:
+                    return dict((tp, len(kafka.topics[self.topic])) for tp in partitions)
+
+            def position(self, partition):
+                return self.position_
+
+            def poll(self, timeout_ms=0, max_records=500):
+                if not self.assigned:
+                    # Like kafka-python, partitions are assigned on the first poll
+                    self.assigned = True
+                    return {}
+                with kafka.lock:
+                    records = kafka.topics[self.topic][self.position_:self.position_ + max_records]
+                if not records:
+                    time.sleep(timeout_ms / 1000.0)
+                    return {}
+                self.position_ += len(records)
+                return {(self.topic, 0): records}
+
+            def close(self):
+                pass
+
+        class KafkaProducer(object):
+            def __init__(self, **config):
+                pass
+
+            def send(self, topic, value=None, key=None):
+                kafka.append(topic, value, key)
+
+            def flush(self, timeout=None):
+                pass
+
+            def close(self, timeout=None):
+                pass
+
+        module.errors = errors
+        module.admin = admin
+        module.KafkaAdminClient = KafkaAdminClient
+        module.KafkaConsumer = KafkaConsumer
+        module.KafkaProducer = KafkaProducer
+        return module
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark and regression harness for logMonitor.
+
+Builds CloudWatch Logs subscription payloads (gzipped, base64 encoded
+awslogs.data documents) from synthetic geth log lines or from a captured log
+export, feeds them through masterHandler / replicaHandler with a stubbed
+CloudWatch client, and reports throughput, per-line parse time, API calls per
+invocation and peak memory. Nothing here talks to AWS.
+
+    python3 devops/benchmarks/logMonitorBench.py --events 5000 --invocations 20
+    python3 devops/benchmarks/logMonitorBench.py --replay geth-export.json
+    python3 devops/benchmarks/logMonitorBench.py --check
+"""
+
+import argparse
+import base64
+import datetime
+import gzip
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("CLUSTER_ID", "bench")
+
+
+class StubCloudWatch(object):
+    """Records put_metric_data calls instead of sending them."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.metrics = 0
+
+    def put_metric_data(self, Namespace, MetricData):
+        with self.lock:
+            self.calls += 1
+            self.metrics += len(MetricData)
+        return {}
+
+
+import awsUtils  # noqa: E402
+import logMonitor  # noqa: E402
+
+# Handlers get their clients from awsUtils, so with the stub in place boto3 is
+# never imported and need not be installed.
+cloudwatch = StubCloudWatch()
+awsUtils.clients["cloudwatch"] = cloudwatch
+
+
+# Reference implementation: the regexes logMonitor used before the single pass
+# parser. --check compares parseLogLine against these.
+LEGACY_AGE = r"(\d+w)?(\d+d)?(\d+h)?(\d+m)?(\d+s)?"
+LEGACY_RE = {
+    "number": re.compile(r"number=(\d+)"),
+    "blockNumber": re.compile(r"blockNumber: (\d+)"),
+    "age": re.compile(r"age=" + LEGACY_AGE),
+    "blockAge": re.compile(r"blockAge=" + LEGACY_AGE),
+    "num": re.compile(r"num=(\d+)"),
+    "offset": re.compile(r"offset=(\d+)"),
+    "offsetAge": re.compile(r"offsetAge=" + LEGACY_AGE),
+    "delta": re.compile(r"delta=(\d+w)?(\d+d)?(\d+h)?(\d+m(?!s))?(\d+(?:[.]\d+)?s)?(\d+(?:[.]\d+)?ms)?"),
+    "peerCount": re.compile(r"peerCount: (\d+)"),
+    "concurrency": re.compile(r"Serving (\d+) concurrent"),
+    "peersTracked": re.compile(r"peersTracked=(\d+)"),
+    "peersEvicted": re.compile(r"peersEvicted=(\d+)"),
+    "worstPeerScore": re.compile(r"worstPeerScore=(\d+(?:[.]\d+)?)"),
+    "medianPeerScore": re.compile(r"medianPeerScore=(\d+(?:[.]\d+)?)"),
+}
+LEGACY_FLAGS = {
+    "imported": "Imported new chain segment",
+    "backendError": "Error communicating with backend:",
+    "trieMissing": "missing trie node",
+}
+
+
+def legacyParse(message):
+    fields = {}
+    for key, regex in LEGACY_RE.items():
+        m = regex.search(message)
+        if not m:
+            continue
+        groups = m.groups()
+        if key.endswith("Score"):
+            fields[key] = float(groups[0])
+        elif len(groups) == 1:
+            fields[key] = int(groups[0])
+        elif key == "delta":
+            week, day, hour, minute, second, millis = groups
+            ageMs = 0
+            if week:
+                ageMs += int(week[:-1]) * 60 * 60 * 24 * 7 * 1000
+            if day:
+                ageMs += int(day[:-1]) * 60 * 60 * 24 * 1000
+            if hour:
+                ageMs += int(hour[:-1]) * 60 * 60 * 1000
+            if minute:
+                ageMs += int(minute[:-1]) * 60 * 1000
+            if second:
+                ageMs += float(second[:-1]) * 1000
+            if millis:
+                ageMs += float(millis[:-2])
+            fields[key] = ageMs
+        else:
+            ageSec = 0
+            for part, factor in zip(groups, (604800, 86400, 3600, 60, 1)):
+                if part:
+                    ageSec += int(part[:-1]) * factor
+            fields[key] = ageSec
+    for key, text in LEGACY_FLAGS.items():
+        if text in message:
+            fields[key] = True
+    return fields
+
+
+def duration(rng, millis=False):
+    parts = []
+    for unit, limit in (("h", 3), ("m", 59), ("s", 59)):
+        if rng.random() < 0.4:
+            parts.append("%d%s" % (rng.randint(1, limit), unit))
+    if millis:
+        if rng.random() < 0.5:
+            parts.append("%d.%03dms" % (rng.randint(0, 999), rng.randint(0, 999)))
+        elif parts and parts[-1].endswith("s"):
+            parts[-1] = "%s.%03ds" % (parts[-1][:-1], rng.randint(0, 999))
+    return "".join(parts) or "0s"
+
+
+def geth(level, message, **fields):
+    return "%s [%s] %-40s %s" % (
+        level, datetime.datetime.utcnow().strftime("%m-%d|%H:%M:%S.000"),
+        message, " ".join("%s=%s" % kv for kv in fields.items()))
+
+
+def replicaLine(rng, block):
+    roll = rng.random()
+    if roll < 0.35:
+        return geth("INFO", "Replica Sync", num=block, hash="0x%064x" % block,
+                    blockAge=duration(rng), offset=block * 7,
+                    offsetAge=duration(rng), delta=duration(rng, True))
+    if roll < 0.45:
+        return "WARN [%s] Serving %d concurrent requests" % (
+            datetime.datetime.utcnow().strftime("%m-%d|%H:%M:%S.000"),
+            rng.randint(1, 500))
+    if roll < 0.47:
+        return geth("ERROR", "Error communicating with backend: timeout")
+    if roll < 0.48:
+        return geth("ERROR", "Failed to serve request",
+                    err='"missing trie node %064x"' % block)
+    return geth("DEBUG", "Served eth_call", conn="10.0.%d.%d:4123" % (
+        rng.randint(0, 255), rng.randint(0, 255)), reqid=rng.randint(0, 10000),
+        t=duration(rng, True))
+
+
+def masterLine(rng, block):
+    roll = rng.random()
+    if roll < 0.3:
+        return geth("INFO", "Imported new chain segment", blocks=1,
+                    txs=rng.randint(0, 400), mgas="%.3f" % (rng.random() * 30),
+                    elapsed=duration(rng, True), number=block,
+                    hash="0x%064x" % block, age=duration(rng),
+                    dirty="%d.00MiB" % rng.randint(100, 1024))
+    if roll < 0.4:
+        return "INFO:__main__:blockNumber: %d" % block
+    if roll < 0.5:
+        return "INFO:__main__:peerCount: %d" % rng.randint(0, 25)
+    if roll < 0.55:
+        return ("INFO:__main__:peerScores: peersTracked=%d peersEvicted=%d "
+                "worstPeerScore=%.3f medianPeerScore=%.3f" % (
+                    rng.randint(0, 25), rng.randint(0, 2), rng.random() / 2,
+                    0.5 + rng.random() / 2))
+    if roll < 0.6:
+        return "INFO:__main__:telemetry: " + json.dumps({
+            "v": 1, "peerCount": rng.randint(0, 25), "syncing": False, "syncLag": 0,
+            "headNumber": block, "headTimestamp": int(time.time()) - 5, "headAge": 5.0,
+            "txpoolPending": rng.randint(0, 5000), "txpoolQueued": rng.randint(0, 500),
+            "freezerBlocks": block - 90000,
+        }, sort_keys=True, separators=(",", ":"))
+    return geth("INFO", "Commit new mining work", number=block,
+                sealhash="0x%064x" % block, uncles=0, txs=rng.randint(0, 400),
+                gas=rng.randint(0, 15000000), fees=rng.random(),
+                elapsed=duration(rng, True))
+
+
+def journaldRecord(message, unit="geth.service"):
+    # journald-cloudwatch-logs ships each journal entry as a JSON document.
+    return json.dumps({
+        "instanceId": "i-0123456789abcdef0",
+        "systemdUnit": unit,
+        "hostname": "ip-10-0-0-1",
+        "transport": "stdout",
+        "priority": "INFO",
+        "message": message,
+    })
+
+
+def buildPayload(messages, logStream="i-0123456789abcdef0", start=None, **dumpArgs):
+    """
+    Wrap messages (strings, or (timestamp, message) tuples) in a CloudWatch
+    Logs subscription event. dumpArgs are passed to json.dumps, to vary the
+    whitespace and separators of the document.
+    """
+    start = start or int(time.time() * 1000)
+    events = []
+    for i, message in enumerate(messages):
+        if isinstance(message, tuple):
+            timestamp, message = message
+        else:
+            timestamp = start + i * 5
+        events.append({"id": str(i), "timestamp": timestamp, "message": message})
+    document = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "bench",
+        "logStream": logStream,
+        "subscriptionFilters": ["bench"],
+        "logEvents": events,
+    }
+    return {"awslogs": {"data": base64.b64encode(gzip.compress(
+        json.dumps(document, **dumpArgs).encode("utf8"))).decode("ascii")}}
+
+
+def syntheticMessages(kind, count, seed):
+    rng = random.Random(seed)
+    generate = masterLine if kind == "master" else replicaLine
+    block = 12000000 + seed * count
+    messages = []
+    for i in range(count):
+        if rng.random() < 0.1:
+            block += 1
+        messages.append(journaldRecord(generate(rng, block)))
+    return messages
+
+
+def readReplay(path):
+    """
+    Read captured log lines. Accepts `aws logs filter-log-events` output
+    (a JSON document with an "events" or "logEvents" list), `journalctl -o
+    json` output (one JSON object per line with a MESSAGE field), CloudWatch
+    Logs S3 exports (an ISO timestamp followed by the message) or plain text.
+    Returns a list of (timestamp, message) tuples.
+    """
+    opener = gzip.open if path.endswith(".gz") else io.open
+    with opener(path, "rt") as f:
+        text = f.read()
+    try:
+        document = json.loads(text)
+    except ValueError:
+        document = None
+    if isinstance(document, dict):
+        events = document.get("events") or document.get("logEvents") or []
+        return [(e["timestamp"], e["message"]) for e in events]
+    now = int(time.time() * 1000)
+    result = []
+    for i, line in enumerate(text.splitlines()):
+        if not line.strip():
+            continue
+        timestamp = now + i
+        if line.startswith("{"):
+            record = json.loads(line)
+            if "MESSAGE" in record:
+                if "__REALTIME_TIMESTAMP" in record:
+                    timestamp = int(record["__REALTIME_TIMESTAMP"]) // 1000
+                line = journaldRecord(record["MESSAGE"],
+                                      record.get("_SYSTEMD_UNIT", "geth.service"))
+            elif "message" in record:
+                timestamp = record.get("timestamp", timestamp)
+                line = record["message"]
+        else:
+            stamp, _, rest = line.partition(" ")
+            try:
+                parsed = datetime.datetime.strptime(stamp[:19], "%Y-%m-%dT%H:%M:%S")
+            except ValueError:
+                pass
+            else:
+                timestamp = int((parsed - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+                line = rest
+        result.append((timestamp, line))
+    return result
+
+
+def bench(handlerName, batches):
+    handler = getattr(logMonitor, handlerName)
+    messages = [e[1] if isinstance(e, tuple) else e for batch in batches for e in batch]
+    payloads = [buildPayload(batch) for batch in batches]
+
+    start = time.perf_counter()
+    for message in messages:
+        logMonitor.parseLogLine(message)
+    parseTime = time.perf_counter() - start
+
+    cloudwatch.reset()
+    sink = io.StringIO()
+    stdout, sys.stdout = sys.stdout, sink
+    try:
+        start = time.perf_counter()
+        for payload in payloads:
+            handler(payload, None)
+        elapsed = time.perf_counter() - start
+        calls, metrics = cloudwatch.calls, cloudwatch.metrics
+        emfBytes = len(sink.getvalue())
+
+        tracemalloc.start()
+        handler(payloads[0], None)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        sys.stdout = stdout
+    return {
+        "handler": handlerName,
+        "sink": logMonitor.METRIC_SINK,
+        "invocations": len(payloads),
+        "events": len(messages),
+        "eventsPerSecond": len(messages) / elapsed if elapsed else None,
+        "parseMicrosPerLine": parseTime / len(messages) * 1e6 if messages else None,
+        "apiCallsPerInvocation": calls / len(payloads),
+        "metricsPerInvocation": metrics / len(payloads),
+        "emfBytesPerInvocation": emfBytes / len(payloads),
+        "peakMemoryBytes": peak,
+    }
+
+
+def check(messages, samples):
+    """
+    Compare parseLogLine with the legacy regexes, and the duration parsers
+    with the legacy duration grammars on random tokens. Returns a list of
+    mismatches.
+    """
+    mismatches = []
+    for message in messages:
+        expected = legacyParse(message)
+        parsed = logMonitor.parseLogLine(message)._asdict()
+        actual = dict((k, v) for k, v in parsed.items() if v is not None)
+        if expected != actual:
+            mismatches.append({"message": message, "expected": expected,
+                               "actual": actual})
+    rng = random.Random(0)
+    alphabet = "0123456789wdhms.x"
+    for _ in range(samples):
+        token = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 10)))
+        expected = legacyParse(" delta=%s age=%s" % (token, token))
+        if expected.get("delta") != logMonitor.durationMs(token):
+            mismatches.append({"delta": token, "expected": expected["delta"],
+                               "actual": logMonitor.durationMs(token)})
+        if expected.get("age") != logMonitor.durationSeconds(token):
+            mismatches.append({"age": token, "expected": expected["age"],
+                               "actual": logMonitor.durationSeconds(token)})
+    return mismatches
+
+
+# Layouts of the subscription document --check decodes, each at every chunk
+# size in DECODE_CHUNK_SIZES, so whitespace and separators land on chunk
+# boundaries.
+DECODE_LAYOUTS = [
+    {},
+    {"indent": 2},
+    {"separators": (" , ", " : ")},
+    {"indent": "\t", "separators": (",\n ", ": ")},
+]
+DECODE_CHUNK_SIZES = [4, 8, 12, 16, 20, 64, 256, 1024]
+
+
+def checkDecoding(messages):
+    """
+    Decode payloads built from messages with LogEventStream in each layout and
+    chunk size, comparing the header and events with json.loads. Returns a list
+    of mismatches.
+    """
+    mismatches = []
+    for layout in DECODE_LAYOUTS:
+        payload = buildPayload(messages, start=1, **layout)
+        document = json.loads(gzip.decompress(base64.b64decode(payload["awslogs"]["data"])))
+        for chunkSize in DECODE_CHUNK_SIZES:
+            try:
+                stream = logMonitor.LogEventStream(payload["awslogs"]["data"], chunkSize)
+                events = list(stream)
+                header = stream.header
+            except ValueError as e:
+                events, header = str(e), None
+            if events != document["logEvents"] or header.get("logStream") != document["logStream"]:
+                mismatches.append({"layout": repr(layout), "chunkSize": chunkSize,
+                                   "error": events if isinstance(events, str) else "events differ"})
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--handler", choices=["master", "replica", "both"], default="both")
+    parser.add_argument("--events", type=int, default=2000,
+                        help="log events per invocation")
+    parser.add_argument("--invocations", type=int, default=10)
+    parser.add_argument("--replay", help="captured log export to replay")
+    parser.add_argument("--check", action="store_true",
+                        help="compare the parser against the legacy regexes, and "
+                             "check decoding across chunk boundaries")
+    parser.add_argument("--samples", type=int, default=100000,
+                        help="random duration tokens checked by --check")
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    args = parser.parse_args()
+
+    handlers = ["master", "replica"] if args.handler == "both" else [args.handler]
+    results = []
+    failures = []
+    for kind in handlers:
+        if args.replay:
+            replay = readReplay(args.replay)
+            batches = [replay[i:i + args.events] for i in range(0, len(replay), args.events)]
+        else:
+            batches = [syntheticMessages(kind, args.events, seed)
+                       for seed in range(args.invocations)]
+        if args.check:
+            failures.extend(check(
+                [e[1] if isinstance(e, tuple) else e for batch in batches for e in batch],
+                args.samples if kind == handlers[0] else 0))
+            failures.extend(checkDecoding(batches[0][:50]))
+        results.append(bench(kind + "Handler", batches))
+
+    if args.json:
+        print(json.dumps({"results": results, "mismatches": failures}, indent=2))
+    else:
+        for result in results:
+            print("%(handler)s (%(sink)s): %(events)d events in %(invocations)d invocations" % result)
+            print("  %12.0f events/s" % result["eventsPerSecond"])
+            print("  %12.2f us parse time per line" % result["parseMicrosPerLine"])
+            print("  %12.2f put_metric_data calls per invocation" % result["apiCallsPerInvocation"])
+            print("  %12.1f metrics per invocation" % result["metricsPerInvocation"])
+            print("  %12.0f EMF bytes per invocation" % result["emfBytesPerInvocation"])
+            print("  %12.0f bytes peak memory" % result["peakMemoryBytes"])
+        if args.check:
+            print("%d parser and decoding mismatches" % len(failures))
+            for failure in failures[:10]:
+                print("  %s" % json.dumps(failure))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
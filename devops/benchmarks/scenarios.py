@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+"""
+Offline load scenarios for the devops Lambdas and peerManager.
+
+Each scenario seeds the in-process fakes in fakes.py (EC2, CloudWatch, SNS,
+SSM, the tagging API, a geth IPC socket, Kafka, or local HTTP JSON-RPC
+providers), runs the unmodified handler against them and reports wall time,
+API calls by operation and peak memory. Every fake AWS call can be given a
+latency and a throttling rate, so the numbers include retries. Run each
+scenario before and after a change to see its effect.
+
+    python3 devops/benchmarks/scenarios.py
+    python3 devops/benchmarks/scenarios.py --scenario gcSnapshot --scale 10
+    python3 devops/benchmarks/scenarios.py --latency 0.02 --throttle 0.05 --json
+"""
+
+import argparse
+import collections
+import datetime
+import http.server
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+
+fakes.install()
+os.environ.setdefault("CLUSTER_ID", "bench")
+
+import awsUtils  # noqa: E402
+import gcSnapshot  # noqa: E402
+import getSnapshot  # noqa: E402
+import logMonitor  # noqa: E402
+import masterVolumeManager  # noqa: E402
+import remote_metrics  # noqa: E402
+import volumeGC  # noqa: E402
+import logMonitorBench  # noqa: E402
+
+kafka = fakes.InMemoryKafka()
+sys.modules["kafka"] = kafka.module()
+try:
+    import peerManager
+except ImportError as e:
+    # peerManager also needs six, which is not always installed
+    peerManager = None
+    peerManagerMissing = str(e)
+
+
+def gcSnapshotScenario(aws, scale, options):
+    """Retention over 10k snapshots a day apart, a fifth of them today or yesterday"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    count = 10000 * scale
+    rng = random.Random(options.seed)
+    for i in range(count):
+        if i % 5 == 0:
+            age = datetime.timedelta(hours=rng.uniform(0, 48))
+        else:
+            age = datetime.timedelta(days=rng.uniform(2, 365))
+        aws.ec2.addSnapshot("snap-%017x" % i, now - age,
+                            progress="100%" if i % 100 else "40%",
+                            tags={"cluster": os.environ["CLUSTER_ID"]})
+    os.environ["SNAPSHOT_ID"] = "snap-%017x" % 0
+
+    def run():
+        result = gcSnapshot.handler({}, None)
+        return {"snapshots": result["snapshots"], "deleted": len(result["deleted"]),
+                "failed": len(result["failed"])}
+    return run
+
+
+def volumeGCScenario(aws, scale, options):
+    """An instance launch detaching its volume, with a backlog of tagged volumes"""
+    count = 200 * scale
+    for i in range(count):
+        aws.ec2.addVolume("vol-%017x" % i, tags={"DELETE_ON_DETACH": "True"},
+                          instanceId="i-attached" if i % 10 == 0 else None)
+    os.environ["VOLUME_NAME"] = "/dev/sdf"
+    aws.ec2.addVolume("vol-launch", instanceId="i-launch")
+    aws.ec2.addInstance("i-launch", "r5d.large", tags={"VOLUME_MGMT_GROUP": "X"},
+                        volumes={"/dev/sdf": "vol-launch"})
+    aws.ec2.detachDelay = options.detachDelay
+    event = {"detail": {"state": "pending", "instance-id": "i-launch"}}
+
+    def run():
+        return volumeGC.handler(event, None)
+    return run
+
+
+def getSnapshotScenario(aws, scale, options):
+    """Repeated launches with the first half of the candidates out of capacity"""
+    subnets = ["subnet-%d" % i for i in range(3)]
+    for i, subnet in enumerate(subnets):
+        aws.ec2.subnets[subnet] = "us-east-1%s" % "abc"[i]
+    candidates = [(aws.ec2.subnets[s], t) for s in subnets for t in getSnapshot.INSTANCE_TYPES]
+    aws.ec2.noCapacity = set(candidates[:len(candidates) // 2])
+    os.environ.update({
+        "SUBNET_ID": ",".join(subnets),
+        "LAUNCH_TEMPLATE_ID": "lt-bench",
+        "LAUNCH_TEMPLATE_VERSION": "1",
+    })
+    getSnapshot.CAPACITY_PARAMETER = "/bench/capacity"
+    getSnapshot.capacityCache.clear()
+
+    def run():
+        launched = 0
+        for _ in range(20 * scale):
+            if getSnapshot.handler({}, None)["instanceId"]:
+                launched += 1
+        return {"invocations": 20 * scale, "launched": launched}
+    return run
+
+
+def masterVolumeManagerScenario(aws, scale, options):
+    """Two checks over 500 master volumes, a tenth of them nearly full"""
+    count = 500 * scale
+    os.environ.update({"VOLUME_NAME": "master", "ATTACHMENT_DEVICE": "/dev/sdf"})
+    # Usage based growth is opt-in; enable it as a stack with DiskGrowAtPercent would
+    masterVolumeManager.GROW_AT_PERCENT = 80
+    for i in range(count):
+        instanceId = "i-%017x" % i
+        volumeId = "vol-%017x" % i
+        group = "master-%d" % (i % 10)
+        aws.ec2.addInstance(instanceId, tags={"aws:autoscaling:groupName": group},
+                            volumes={"/dev/sdf": volumeId})
+        aws.ec2.addVolume(volumeId, 1000, instanceId, tags={"Name": "master"})
+        aws.cloudwatch.metricValues[group] = 90 if group == "master-0" else 50
+
+    def run():
+        first = masterVolumeManager.sizeHandler({}, None)
+        second = masterVolumeManager.sizeHandler({}, None)
+        return {"volumes": first["volumes"], "resized": first["resized"],
+                "busyAfterResize": len(second["busy"])}
+    return run
+
+
+class RPCServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def rpcServer(head, latency):
+    """A local HTTP JSON-RPC endpoint answering with a fixed head block"""
+    counter = collections.Counter()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out as separate writes, which Nagle's algorithm
+        # would hold up for a delayed ACK on every keep-alive request
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            counter[request["method"]] += 1
+            if latency:
+                time.sleep(latency)
+            if request["method"] == "eth_getBlockByNumber":
+                result = {"number": hex(head), "timestamp": hex(int(time.time()) - 3)}
+            else:
+                result = hex(head)
+            body = json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": result}).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = RPCServer(("127.0.0.1", 0), Handler)
+    server.counter = counter
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def remoteMetricsScenario(aws, scale, options):
+    """Repeated probes of three providers and two cluster endpoints over HTTP"""
+    providers = [rpcServer(12000000 + i, options.latency) for i in range(3)]
+    clusters = [rpcServer(11999999 - i, options.latency) for i in range(2)]
+    url = lambda server: "http://127.0.0.1:%d/" % server.server_address[1]
+    os.environ["RPC_URL"] = ",".join(url(s) for s in providers)
+    remote_metrics.CLUSTER_RPC_URL = ",".join(url(s) for s in clusters)
+    remote_metrics.connections.clear()
+
+    def run():
+        try:
+            for _ in range(20 * scale):
+                remote_metrics.handler({}, None)
+        finally:
+            for server in providers + clusters:
+                server.shutdown()
+                server.server_close()
+        for server in providers + clusters:
+            for method, count in server.counter.items():
+                aws.external["http." + method] += count
+        return {"invocations": 20 * scale}
+    return run
+
+
+def logMonitorScenario(aws, scale, options):
+    """Master and replica log batches of 2000 events each"""
+    batches = [(handler, logMonitorBench.buildPayload(
+        logMonitorBench.syntheticMessages(kind, 2000, seed)))
+        for seed in range(5 * scale)
+        for kind, handler in (("master", logMonitor.masterHandler),
+                              ("replica", logMonitor.replicaHandler))]
+
+    def run():
+        for handler, payload in batches:
+            handler(payload, None)
+        return {"invocations": len(batches), "events": 2000 * len(batches)}
+    return run
+
+
+def peerManagerScenario(aws, scale, options):
+    """
+    A master joining a cluster of 500 registered masters, some moved, expired
+    or gone, while geth reports 500 external peers.
+    """
+    if peerManager is None:
+        return None
+    count = 500 * scale
+    now = time.time()
+    kafka.topics.clear()
+    kafka.configs.clear()
+    topic = "bench-peers"
+    registry = topic + peerManager.REGISTRY_TOPIC_SUFFIX
+    live = 0
+    for i in range(count):
+        node = "enode://%0128x" % (i + 1)
+        key = node.encode("utf8")
+        for move in range(3):
+            kafka.append(registry, json.dumps({
+                "enode": "%s@10.0.%d.%d:30303" % (node, move, i % 256),
+                "ts": now - 30 * (3 - move),
+            }).encode("utf8"), key)
+        if i % 20 == 0:
+            kafka.append(registry, None, key)
+        elif i % 20 == 1:
+            kafka.append(registry, json.dumps({
+                "enode": "%s@10.0.9.%d:30303" % (node, i % 256),
+                "ts": now - 2 * peerManager.PEER_TTL,
+            }).encode("utf8"), key)
+        else:
+            live += 1
+    polls = itertools.count()
+
+    def adminPeers():
+        # A third of the external peers keep up, a third lag a few blocks
+        # behind and a third have stalled
+        best = 10 ** 9 + 10 ** 6 * next(polls)
+        return [{
+            "enode": "enode://%0128x@203.0.113.%d:30303" % (10 ** 6 + i, i % 256),
+            "network": {},
+            "protocols": {"eth": {"difficulty": (best, best - 10 ** 6, 10 ** 9)[i % 3]}},
+        } for i in range(count)]
+    directory = tempfile.mkdtemp()
+    geth = fakes.FakeGeth(os.path.join(directory, "geth.ipc"), {
+        "admin_nodeInfo": lambda: {
+            "enode": "enode://%0128x@127.0.0.1:30303" % 0,
+            "protocols": {"eth": {"difficulty": 10 ** 12}},
+        },
+        "admin_addTrustedPeer": lambda enode: True,
+        "admin_removeTrustedPeer": lambda enode: True,
+        "admin_addPeer": lambda enode: True,
+        "admin_peers": adminPeers,
+        "admin_removePeer": lambda enode: True,
+        "eth_blockNumber": lambda: hex(12000000),
+        "eth_syncing": lambda: False,
+        "eth_getBlockByNumber": lambda number, full: {
+            "number": hex(12000000), "timestamp": hex(int(time.time()) - 5)},
+        "net_peerCount": lambda: hex(count),
+        "txpool_status": lambda: {"pending": hex(4096), "queued": hex(128)},
+    }, latency=options.latency)
+    peerManager.SYNCED_INTERVAL = peerManager.IDLE_INTERVAL = 0.05
+    checks = 20
+
+    def run():
+        manager = peerManager.PeerManager(geth.path, {}, topic)
+        start = time.time()
+        for thread in manager.threads:
+            thread.daemon = True
+            thread.start()
+        caughtUp = None
+        deadline = start + 120
+        while time.time() < deadline and not manager.stop.is_set():
+            if caughtUp is None and geth.calls["admin_addTrustedPeer"] >= live:
+                caughtUp = time.time() - start
+            if caughtUp is not None and geth.calls["admin_peers"] >= checks:
+                break
+            time.sleep(0.01)
+        manager.stop.set()
+        manager.backend.close()
+        for thread in manager.threads:
+            thread.join(peerManager.SHUTDOWN_TIMEOUT)
+        geth.close()
+        shutil.rmtree(directory, ignore_errors=True)
+        for method, calls in geth.calls.items():
+            aws.external["geth." + method] += calls
+        aws.external["geth.requests"] += geth.requests
+        # Expired masters are tombstoned, and we tombstone ourselves on the way
+        # out, so compaction should leave only the live masters.
+        kafka.compact(registry)
+        return {"records": count * 3 + count // 10, "trustedPeers": geth.calls["admin_addTrustedPeer"],
+                "expectedTrustedPeers": live, "catchUpSeconds": caughtUp, "externalChecks": checks,
+                "evicted": geth.calls["admin_removePeer"], "failed": manager.failed,
+                "registeredAfterCompaction": len(kafka.topics[registry])}
+    return run
+
+
+SCENARIOS = collections.OrderedDict([
+    ("gcSnapshot", gcSnapshotScenario),
+    ("volumeGC", volumeGCScenario),
+    ("getSnapshot", getSnapshotScenario),
+    ("masterVolumeManager", masterVolumeManagerScenario),
+    ("remote_metrics", remoteMetricsScenario),
+    ("logMonitor", logMonitorScenario),
+    ("peerManager", peerManagerScenario),
+])
+
+
+def bench(name, options):
+    """
+    Runs a scenario once for timing and call counts, then against fresh fakes
+    under tracemalloc for peak memory.
+    """
+    aws = fakes.FakeAWS(options.latency, options.throttle, options.seed)
+    fakes.current = aws
+    awsUtils.clients.clear()
+    awsUtils.resources.clear()
+    run = SCENARIOS[name](aws, options.scale, options)
+    if run is None:
+        return {"scenario": name, "skipped": peerManagerMissing}
+    start = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - start
+    calls, throttled = aws.calls(), aws.throttled()
+
+    aws = fakes.FakeAWS(options.latency, options.throttle, options.seed)
+    fakes.current = aws
+    awsUtils.clients.clear()
+    awsUtils.resources.clear()
+    run = SCENARIOS[name](aws, options.scale, options)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "scenario": name,
+        "wallSeconds": elapsed,
+        "apiCalls": collections.OrderedDict(sorted(calls.items())),
+        "totalApiCalls": sum(calls.values()),
+        "throttled": throttled,
+        "peakMemoryBytes": peak,
+        "result": result,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="scenario to run (repeatable, default all)")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="multiplies the number of snapshots, volumes, peers and invocations")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds added to every fake API, RPC and IPC call")
+    parser.add_argument("--throttle", type=float, default=0.05,
+                        help="fraction of AWS calls throttled")
+    parser.add_argument("--detach-delay", dest="detachDelay", type=float, default=1,
+                        help="seconds a detached volume takes to become available")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    for name in ("gcSnapshot", "getSnapshot", "logMonitor", "masterVolumeManager",
+                 "peerManager", "remote_metrics", "volumeGC", "awsUtils"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    results = [bench(name, args) for name in args.scenario or SCENARIOS]
+    if args.json:
+        print(json.dumps(results, indent=2, default=str))
+        return
+    for result in results:
+        if "skipped" in result:
+            print("%(scenario)s: skipped (%(skipped)s)" % result)
+            continue
+        print("%(scenario)s: %(wallSeconds).3fs, %(totalApiCalls)d calls "
+              "(%(throttled)d throttled), %(peakMemoryBytes)d bytes peak memory" % result)
+        for operation, count in result["apiCalls"].items():
+            print("  %8d %s" % (count, operation))
+        print("  %s" % json.dumps(result["result"], default=str, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+Cold start benchmark for the devops Lambdas.
+
+Imports each handler's module in a fresh interpreter, as a new Lambda
+container does, then creates the boto3 clients its handler uses. Reports the
+import time, the client setup time paid by the first invocation, the whole
+interpreter's wall time and the number of modules loaded, each the median of
+--runs interpreters. A module whose import exceeds its budget fails the run,
+so adding import-time work shows up before it reaches the Lambda bill.
+
+Without boto3 installed the clients come from fakes.py, so client times are
+not meaningful but import times still are.
+
+    python3 devops/benchmarks/startupBench.py
+    python3 devops/benchmarks/startupBench.py --module logMonitor --runs 20 --json
+"""
+
+import argparse
+import collections
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+
+DEVOPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+
+# Clients and resources each handler creates on a typical invocation
+HANDLERS = collections.OrderedDict([
+    ("logMonitor", (["cloudwatch"], [])),
+    ("remote_metrics", (["cloudwatch"], [])),
+    ("gcSnapshot", (["ec2"], [])),
+    ("getSnapshot", (["ssm"], ["ec2"])),
+    ("volumeGC", (["ec2", "resourcegroupstaggingapi"], [])),
+    ("masterVolumeManager", (["ec2", "cloudwatch"], [])),
+])
+# Milliseconds each module may take to import. Handlers create their clients
+# on first use, so nothing here should pay for importing boto3.
+IMPORT_BUDGET_MS = {
+    "logMonitor": 50,
+}
+DEFAULT_BUDGET_MS = 80
+
+CHILD = r"""
+import json, sys, time
+devops, benchmarks, name, clients, resources, fake = sys.argv[1:7]
+sys.path[:0] = [devops, benchmarks]
+if fake == "1":
+    import fakes
+    fakes.install()
+baseline = set(sys.modules)
+start = time.perf_counter()
+__import__(name)
+imported = time.perf_counter()
+boto3Imported = "boto3" in sys.modules and fake != "1"
+import awsUtils
+for service in filter(None, clients.split(",")):
+    awsUtils.getClient(service)
+for service in filter(None, resources.split(",")):
+    awsUtils.getResource(service)
+ready = time.perf_counter()
+print(json.dumps({
+    "importMs": (imported - start) * 1000,
+    "clientMs": (ready - imported) * 1000,
+    "modules": len(set(sys.modules) - baseline),
+    "boto3Imported": boto3Imported,
+}))
+"""
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(name, runs, fake):
+    clients, resources = HANDLERS[name]
+    env = dict(os.environ)
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    env.setdefault("CLUSTER_ID", "bench")
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.check_output([
+            sys.executable, "-c", CHILD, DEVOPS, BENCHMARKS, name,
+            ",".join(clients), ",".join(resources), "1" if fake else "0",
+        ], env=env)
+        sample = json.loads(output.decode("utf8"))
+        sample["processMs"] = (time.perf_counter() - start) * 1000
+        samples.append(sample)
+    budget = IMPORT_BUDGET_MS.get(name, DEFAULT_BUDGET_MS)
+    importMs = median([s["importMs"] for s in samples])
+    return {
+        "module": name,
+        "runs": runs,
+        "importMs": importMs,
+        "clientMs": median([s["clientMs"] for s in samples]),
+        "processMs": median([s["processMs"] for s in samples]),
+        "modules": median([s["modules"] for s in samples]),
+        "boto3AtImport": any(s["boto3Imported"] for s in samples),
+        "budgetMs": budget,
+        "overBudget": importMs > budget,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--module", action="append", choices=list(HANDLERS),
+                        help="module to measure (repeatable, default all)")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    args = parser.parse_args()
+
+    fake = importlib.util.find_spec("boto3") is None
+    results = [measure(name, args.runs, fake) for name in args.module or HANDLERS]
+    if args.json:
+        print(json.dumps({"fakeClients": fake, "results": results}, indent=2))
+    else:
+        if fake:
+            print("boto3 is not installed; client times use fakes.py")
+        for result in results:
+            print("%(module)-20s import %(importMs)6.1fms (budget %(budgetMs)sms)  "
+                  "clients %(clientMs)6.1fms  process %(processMs)6.1fms  "
+                  "%(modules)4d modules%(flag)s" % dict(
+                      result, flag=" OVER BUDGET" if result["overBudget"] else ""))
+    if any(result["overBudget"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,125 @@
-import boto3
 import os
 import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from awsUtils import callWithBackoff, getClient
+from instrumentation import PhaseTimer, profiled
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
-ec2 = boto3.client('ec2')
-sns = boto3.client('sns')
 keep_count = int(os.environ.get("KEEP_COUNT", 2))
 today_keep_count = int(os.environ.get("TODAY_KEEP_COUNT", 2))
+yesterday_keep_count = int(os.environ.get("YESTERDAY_KEEP_COUNT", 1))
+# Log the deletion plan without deleting anything
+DRY_RUN = os.environ.get("DRY_RUN", "").lower() in ("1", "true", "yes")
+# Concurrent delete_snapshot calls
+DELETE_WORKERS = int(os.environ.get("DELETE_WORKERS", 8))
+
+
+def notify(subject, message):
+    for topic in os.environ.get("SNS_TOPICS", "").split(";"):
+        if topic:
+            getClient("sns").publish(TopicArn=topic, Subject=subject, Message=message)
+
+
+def listSnapshots(ec2, clusterId):
+    """Yields every snapshot tagged for the cluster, across all result pages"""
+    paginator = ec2.get_paginator("describe_snapshots")
+    for page in paginator.paginate(Filters=[{
+        "Name": "tag:cluster",
+        "Values": [clusterId]
+    }]):
+        for snapshot in page["Snapshots"]:
+            yield snapshot
+
+
+def planDeletions(snapshots, now, keepCount=keep_count,
+                  todayKeepCount=today_keep_count,
+                  yesterdayKeepCount=yesterday_keep_count, protected=()):
+    """
+    Returns the completed snapshots to delete, oldest first. Snapshots are
+    grouped by when they started relative to `now` (a timezone aware datetime):
+    today, yesterday or older. The newest todayKeepCount, yesterdayKeepCount
+    and keepCount snapshots of each group are kept, as are any snapshots whose
+    IDs are in `protected`. Snapshots still in progress are never deleted.
+    """
+    today = datetime.datetime.combine(
+        now.date(), datetime.datetime.min.time()
+    ).replace(tzinfo=now.tzinfo)
+    yesterday = today - datetime.timedelta(days=1)
+    buckets = ([], [], [])
+    for snapshot in snapshots:
+        if snapshot["Progress"] != "100%":
+            continue
+        if snapshot["StartTime"] >= today:
+            buckets[0].append(snapshot)
+        elif snapshot["StartTime"] >= yesterday:
+            buckets[1].append(snapshot)
+        else:
+            buckets[2].append(snapshot)
+    protected = set(protected)
+    deletions = []
+    for bucket, keep in zip(buckets, (todayKeepCount, yesterdayKeepCount, keepCount)):
+        bucket.sort(key=lambda i: i["StartTime"])
+        deletions.extend(i for i in bucket[:max(len(bucket) - keep, 0)]
+                         if i["SnapshotId"] not in protected)
+    deletions.sort(key=lambda i: i["StartTime"])
+    return deletions
+
+
+def deleteSnapshots(ec2, snapshotIds, workers=DELETE_WORKERS):
+    """
+    Deletes snapshots over a bounded thread pool, retrying throttled calls with
+    backoff. Returns the IDs deleted and a dict of IDs that failed to the error.
+    """
+    def delete(snapshotId):
+        try:
+            callWithBackoff(ec2.delete_snapshot, SnapshotId=snapshotId)
+        except Exception as e:
+            logger.warning("Failed to delete %s: %s", snapshotId, e)
+            return e
+    deleted, failed = [], {}
+    if not snapshotIds:
+        return deleted, failed
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for snapshotId, error in zip(snapshotIds, executor.map(delete, snapshotIds)):
+            if error is None:
+                deleted.append(snapshotId)
+            else:
+                failed[snapshotId] = str(error)
+    return deleted, failed
 
 
+@profiled
 def handler(event, context):
+    timer = PhaseTimer("gcSnapshot")
+    ec2 = getClient("ec2")
+    now = datetime.datetime.now(datetime.timezone.utc)
     try:
         current_snap = ec2.describe_snapshots(SnapshotIds=[os.environ.get("SNAPSHOT_ID")])["Snapshots"]
     except Exception as e:
-        topics = os.environ.get("SNS_TOPICS").split(";")
-        for topic in topics:
-            if topic:
-                sns.publish(
-                    TopicArn=topic,
-                    Subject="Warning: %s snapshot unavailable" % os.environ.get("CLUSTER_ID"),
-                    Message="The current snapshot for cluster %(CLUSTER_ID)s is %(SNAPSHOT_ID)s, but could not be found." % os.environ,
-                )
+        notify(
+            "Warning: %s snapshot unavailable" % os.environ.get("CLUSTER_ID"),
+            "The current snapshot for cluster %(CLUSTER_ID)s is %(SNAPSHOT_ID)s, but could not be found." % os.environ,
+        )
     else:
-        now = datetime.datetime.utcnow().replace(tzinfo=current_snap[0]["StartTime"].tzinfo)
         if now - current_snap[0]["StartTime"] > datetime.timedelta(hours=12):
-            topics = os.environ.get("SNS_TOPICS").split(";")
-            for topic in topics:
-                if topic:
-                    sns.publish(
-                        TopicArn=topic,
-                        Subject="Warning: %s Snapshot outdated" % os.environ.get("CLUSTER_ID"),
-                        Message="The current snapshot for cluster %(CLUSTER_ID)s is %(SNAPSHOT_ID)s, but it is over 12 hours old." % os.environ,
-                    )
-
-    rsp = ec2.describe_snapshots(
-        Filters=[{
-            "Name": "tag:cluster",
-            "Values": [os.environ.get("CLUSTER_ID")]
-        }]
-    )
-    sorted_snaps = sorted(
-        [i for i in rsp["Snapshots"] if i["Progress"] == "100%"],
-        key=lambda i: i["StartTime"]
-    )
-    today = datetime.datetime.combine(
-            datetime.date.today(), datetime.datetime.min.time()
-        ).replace(tzinfo=sorted_snaps[0]["StartTime"].tzinfo)
-    yesterday = today - datetime.timedelta(days=1)
-    today_snaps = [i for i in sorted_snaps if i["StartTime"] >= today]
-    yesterday_snaps = [i for i in sorted_snaps if yesterday <= i["StartTime"] < today]
-    older_snaps = [i for i in sorted_snaps if i["StartTime"] < yesterday]
-    for snapshot in today_snaps[:-today_keep_count] + older_snaps[:-keep_count] + yesterday_snaps[:-1]:
-        if snapshot["SnapshotId"] != os.environ.get("SNAPSHOT_ID"):
-            ec2.delete_snapshot(
-                SnapshotId=snapshot["SnapshotId"]
+            notify(
+                "Warning: %s Snapshot outdated" % os.environ.get("CLUSTER_ID"),
+                "The current snapshot for cluster %(CLUSTER_ID)s is %(SNAPSHOT_ID)s, but it is over 12 hours old." % os.environ,
             )
+
+    with timer.phase("list"):
+        snapshots = list(listSnapshots(ec2, os.environ.get("CLUSTER_ID")))
+    with timer.phase("plan"):
+        deletions = planDeletions(snapshots, now, protected=[os.environ.get("SNAPSHOT_ID")])
+        snapshotIds = [i["SnapshotId"] for i in deletions]
+    logger.info("%s of %s snapshots to delete%s: %s", len(snapshotIds),
+                len(snapshots), " (dry run)" if DRY_RUN else "", snapshotIds)
+    deleted, failed = [], {}
+    if not DRY_RUN:
+        with timer.phase("delete"):
+            deleted, failed = deleteSnapshots(ec2, snapshotIds)
+    return {"snapshots": len(snapshots), "plan": snapshotIds, "deleted": deleted,
+            "failed": failed, "phasesMs": timer.log()}
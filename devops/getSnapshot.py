@@ -1,8 +1,11 @@
-import boto3
 import os
-import datetime
+import json
+import time
+import logging
+from awsUtils import errorCode, getClient, getResource
 
-ec2 = boto3.resource('ec2')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 INSTANCE_TYPES = [
     "m5a.large",
@@ -15,32 +18,194 @@ INSTANCE_TYPES = [
     "r5ad.large",
 ]
 
+# SSM parameter remembering recent launch outcomes per (AZ, instance type)
+# between invocations. Without it outcomes are only remembered while the Lambda
+# container stays warm.
+CAPACITY_PARAMETER = os.environ.get("CAPACITY_PARAMETER")
+# Seconds a capacity failure demotes an (AZ, instance type) pair
+CAPACITY_TTL = int(os.environ.get("CAPACITY_TTL", 3600))
+# Seconds a success keeps promoting a pair
+SUCCESS_TTL = int(os.environ.get("SUCCESS_TTL", 7 * 24 * 3600))
+# Set to 0 to launch with create_instances only
+USE_FLEET = os.environ.get("USE_FLEET", "1") not in ("0", "false", "no")
+
+CAPACITY_ERRORS = set([
+    "InsufficientInstanceCapacity",
+    "InsufficientCapacity",
+    "InsufficientFreeAddressesInSubnet",
+    "MaxSpotInstanceCountExceeded",
+    "SpotMaxPriceTooLow",
+    "UnfulfillableCapacity",
+    "capacity-not-available",
+    "price-too-low",
+])
+
+capacityCache = {}
+
+
+def loadCapacity(name):
+    if not name:
+        return capacityCache
+    try:
+        return json.loads(getClient("ssm").get_parameter(Name=name)["Parameter"]["Value"])
+    except Exception as e:
+        if errorCode(e) != "ParameterNotFound":
+            logger.warning("Could not load capacity history from %s: %s", name, e)
+        return {}
+
+
+def saveCapacity(name, cache, now):
+    """Drops expired outcomes, then stores the rest"""
+    for key, outcome in list(cache.items()):
+        if (now - outcome.get("failedAt", 0) > CAPACITY_TTL and
+                now - outcome.get("succeededAt", 0) > SUCCESS_TTL):
+            del cache[key]
+    capacityCache.clear()
+    capacityCache.update(cache)
+    if not name:
+        return
+    try:
+        getClient("ssm").put_parameter(Name=name, Value=json.dumps(cache, sort_keys=True),
+                          Type="String", Overwrite=True)
+    except Exception as e:
+        logger.warning("Could not save capacity history to %s: %s", name, e)
+
+
+def record(cache, zone, instanceType, succeeded, now):
+    outcome = cache.setdefault("%s/%s" % (zone, instanceType), {})
+    outcome["succeededAt" if succeeded else "failedAt"] = now
+
+
+def rankCandidates(candidates, cache, now):
+    """
+    Orders (subnet, zone, instance type) candidates for launching. Pairs that
+    hit a capacity failure within CAPACITY_TTL go last; otherwise the most
+    recently successful pairs go first. Ties keep their configured order.
+    """
+    def rank(item):
+        position, (subnet, zone, instanceType) = item
+        outcome = cache.get("%s/%s" % (zone, instanceType), {})
+        failed = now - outcome.get("failedAt", 0) < CAPACITY_TTL
+        succeeded = outcome.get("succeededAt", 0)
+        if now - succeeded > SUCCESS_TTL:
+            succeeded = 0
+        return (failed, -succeeded, position)
+    return [candidate for _, candidate in sorted(enumerate(candidates), key=rank)]
+
+
+def launchFleet(client, candidates, template, cache, now):
+    """
+    Requests a single spot instance with an instant EC2 Fleet covering every
+    candidate, prioritised in order. Returns the instance ID, or None if the
+    fleet could not place one, along with whether every error the fleet
+    reported was a capacity error.
+    """
+    response = client.create_fleet(
+        Type="instant",
+        TargetCapacitySpecification={
+            "TotalTargetCapacity": 1,
+            "DefaultTargetCapacityType": "spot",
+        },
+        SpotOptions={"AllocationStrategy": "capacity-optimized-prioritized"},
+        LaunchTemplateConfigs=[{
+            "LaunchTemplateSpecification": template,
+            "Overrides": [{
+                "InstanceType": instanceType,
+                "SubnetId": subnet,
+                "Priority": float(priority),
+            } for priority, (subnet, zone, instanceType) in enumerate(candidates)],
+        }],
+    )
+    zones = dict((subnet, zone) for subnet, zone, _ in candidates)
+    errors = response.get("Errors", [])
+    capacityOnly = bool(errors) and all(e.get("ErrorCode") in CAPACITY_ERRORS for e in errors)
+    for error in errors:
+        overrides = error.get("LaunchTemplateAndOverrides", {}).get("Overrides", {})
+        if error.get("ErrorCode") in CAPACITY_ERRORS and "InstanceType" in overrides:
+            record(cache, overrides.get("AvailabilityZone") or zones.get(overrides.get("SubnetId")),
+                   overrides["InstanceType"], False, now)
+        logger.info("Fleet error for %s: %s %s", overrides, error.get("ErrorCode"),
+                    error.get("ErrorMessage"))
+    for instances in response.get("Instances", []):
+        if instances.get("InstanceIds"):
+            overrides = instances.get("LaunchTemplateAndOverrides", {}).get("Overrides", {})
+            record(cache, overrides.get("AvailabilityZone") or zones.get(overrides.get("SubnetId")),
+                   instances.get("InstanceType", overrides.get("InstanceType")), True, now)
+            return instances["InstanceIds"][0], capacityOnly
+    return None, capacityOnly
+
+
+def launchInstances(candidates, template, cache, now):
+    """Tries create_instances on each candidate in turn, returning an instance ID"""
+    for subnet, zone, instanceType in candidates:
+        try:
+            instances = getResource("ec2").create_instances(
+                InstanceType=instanceType,
+                MaxCount=1,
+                MinCount=1,
+                LaunchTemplate=template,
+                SubnetId=subnet,
+                InstanceMarketOptions={
+                    'MarketType': 'spot',
+                    'SpotOptions': {
+                        'SpotInstanceType': 'one-time',
+                    }
+                }
+            )
+        except Exception as e:
+            if errorCode(e) in CAPACITY_ERRORS:
+                record(cache, zone, instanceType, False, now)
+            logger.info("Could not launch %s in %s: %s", instanceType, subnet, e)
+            continue
+        record(cache, zone, instanceType, True, now)
+        return instances[0].id
+    return None
+
 
 def handler(event, context):
     if os.environ.get("INSTANCE_TYPES"):
         instance_types = os.environ.get("INSTANCE_TYPES").split(",")
     else:
         instance_types = INSTANCE_TYPES
-    for subnet in os.environ.get("SUBNET_ID").split(","):
-        for instance_type in instance_types:
-            try:
-                ec2.create_instances(
-                    InstanceType=instance_type,
-                    MaxCount=1,
-                    MinCount=1,
-                    LaunchTemplate={
-                        "LaunchTemplateId": os.environ.get("LAUNCH_TEMPLATE_ID"),
-                        "Version": os.environ.get("LAUNCH_TEMPLATE_VERSION"),
-                    },
-                    SubnetId=subnet,
-                    InstanceMarketOptions={
-                        'MarketType': 'spot',
-                        'SpotOptions': {
-                            'SpotInstanceType': 'one-time',
-                        }
-                    }
-                )
-            except Exception:
-                continue
-            else:
-                return
+    template = {
+        "LaunchTemplateId": os.environ.get("LAUNCH_TEMPLATE_ID"),
+        "Version": os.environ.get("LAUNCH_TEMPLATE_VERSION"),
+    }
+    client = getResource("ec2").meta.client
+    subnets = os.environ.get("SUBNET_ID").split(",")
+    try:
+        zones = dict(
+            (subnet["SubnetId"], subnet["AvailabilityZone"])
+            for subnet in client.describe_subnets(SubnetIds=subnets)["Subnets"]
+        )
+    except Exception as e:
+        # Capacity history is then kept per subnet rather than per AZ
+        logger.warning("Could not look up subnet zones, using subnet IDs: %s", e)
+        zones = {}
+    candidates = [(subnet, zones.get(subnet, subnet), instance_type)
+                  for subnet in subnets for instance_type in instance_types]
+    now = time.time()
+    cache = loadCapacity(CAPACITY_PARAMETER)
+    candidates = rankCandidates(candidates, cache, now)
+    instanceId = None
+    exhausted = False
+    if USE_FLEET:
+        # A fleet that found no capacity has tried every candidate already.
+        # Any other failure, of create_fleet or of its overrides, may not
+        # affect create_instances, so fall back to trying them one by one.
+        try:
+            instanceId, exhausted = launchFleet(client, candidates, template, cache, now)
+        except Exception as e:
+            logger.warning("create_fleet failed, falling back to create_instances: %s", e)
+        else:
+            if instanceId is None and not exhausted:
+                logger.warning("Fleet launched nothing, falling back to create_instances")
+    if instanceId is None and not exhausted:
+        instanceId = launchInstances(candidates, template, cache, now)
+    saveCapacity(CAPACITY_PARAMETER, cache, now)
+    if instanceId is None:
+        logger.error("Could not launch a snapshot generator in any of %s candidates",
+                     len(candidates))
+    else:
+        logger.info("Launched snapshot generator %s", instanceId)
+    return {"instanceId": instanceId}
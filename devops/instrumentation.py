@@ -0,0 +1,124 @@
+import functools
+import io
+import json
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Fraction of invocations of @profiled handlers run under cProfile, such as
+# 0.01 for one in a hundred. 0 disables profiling.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+# Functions listed from each profile, by cumulative time
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", 25))
+
+
+class Phase(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.start(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.stop()
+        return False
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the wall time an invocation spends in each named phase. Phases
+    nest, and time is charged to the innermost phase only, so a loop can run in
+    an "aggregate" phase while the decode and parse work inside it is counted
+    separately. Entering a phase again adds to its total.
+
+        timer = PhaseTimer("gcSnapshot")
+        with timer.phase("list"):
+            ...
+        timer.log()
+    """
+    def __init__(self, name):
+        self.name = name
+        self.totals = {}
+        self.stack = []
+        self.phases = {}
+        self.created = time.perf_counter()
+
+    def phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(self, name)
+        return phase
+
+    def start(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            outer = self.stack[-1]
+            self.totals[outer[0]] = self.totals.get(outer[0], 0) + now - outer[1]
+        self.stack.append([name, now])
+
+    def stop(self):
+        now = time.perf_counter()
+        name, start = self.stack.pop()
+        self.totals[name] = self.totals.get(name, 0) + now - start
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def timed(self, name, iterable):
+        """Yields from iterable, charging the time spent producing each item to name"""
+        iterator = iter(iterable)
+        while True:
+            self.start(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stop()
+            yield item
+
+    def result(self):
+        """Milliseconds spent in each phase"""
+        return dict((name, round(seconds * 1000, 3)) for name, seconds in self.totals.items())
+
+    def log(self):
+        """
+        Logs a "phases: " line with a JSON document of the handler name, the
+        time in each phase and the total since the timer was created.
+        """
+        phases = self.result()
+        logger.info("phases: %s", json.dumps({
+            "handler": self.name,
+            "phasesMs": phases,
+            "totalMs": round((time.perf_counter() - self.created) * 1000, 3),
+        }, sort_keys=True))
+        return phases
+
+
+def profiled(handler):
+    """
+    Runs a PROFILE_SAMPLE_RATE fraction of the handler's invocations under
+    cProfile, logging the PROFILE_TOP functions with the most cumulative time.
+    cProfile only sees the invoking thread, so work done on thread pools shows
+    up as time spent waiting for it.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if not PROFILE_SAMPLE_RATE or random.random() >= PROFILE_SAMPLE_RATE:
+            return handler(event, context)
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(handler, event, context)
+        finally:
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            logger.info("Profile of %s.%s:\n%s", handler.__module__, handler.__name__,
+                        out.getvalue())
+    return wrapper
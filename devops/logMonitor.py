@@ -1,72 +1,339 @@
-import gzip
 import base64
+import codecs
+import collections
 import json
 import re
-import boto3
 import datetime
+from awsUtils import MetricPublisher, getClient
+from instrumentation import PhaseTimer, profiled
+import logging
 import os
+import sys
+import zlib
 
-client = boto3.client('cloudwatch')
-MASTER_BLOCK_NUM_RE = re.compile(r"number=(\d+)")
-PEER_BLOCK_NUM_RE = re.compile(r"blockNumber: (\d+)")
-BLOCK_AGE_RE = re.compile(r"age=(\d+w)?(\d+d)?(\d+h)?(\d+m)?(\d+s)?")
-BLOCK_AGE_REP_RE = re.compile(r"blockAge=(\d+w)?(\d+d)?(\d+h)?(\d+m)?(\d+s)?")
-BLOCK_NUM_REP_RE = re.compile("num=(\d+)")
-OFFSET_NUM_RE = re.compile("offset=(\d+)")
-OFFSET_AGE_RE = re.compile(r"offsetAge=(\d+w)?(\d+d)?(\d+h)?(\d+m)?(\d+s)?")
-DELTA_RE = re.compile(r"delta=(\d+w)?(\d+d)?(\d+h)?(\d+m(?!s))?(\d+(?:[.]\d+)?s)?(\d+(?:[.]\d+)?ms)?")
-PEER_COUNT_RE = re.compile(r"peerCount: (\d+)")
-CONCURRENCY_RE = re.compile(r"Serving (\d+) concurrent")
-
-
-def numberFromRe(message, regex):
-    m = regex.search(message)
-    if not m:
-        raise ValueError("Message does not match regex")
-    return int(m.groups()[0])
-
-
-def ageFromRe(message, regex):
-    m = regex.search(message)
-    if not m:
-        raise ValueError("Message does not match regex")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Each datum may carry up to 150 distinct Values.
+MAX_VALUES_PER_DATUM = 150
+# Size of the base64 chunks decoded, and the most decompressed bytes produced,
+# per step while streaming an awslogs payload.
+DECODE_CHUNK_SIZE = 64 * 1024
+# Datapoints for the same metric and dimensions are combined within buckets of
+# this many seconds. 0 only combines datapoints with identical timestamps.
+METRIC_BUCKET_SECONDS = int(os.environ.get("METRIC_BUCKET_SECONDS", 60))
+# "cloudwatch" publishes with put_metric_data, "emf" writes CloudWatch
+# Embedded Metric Format documents to stdout for asynchronous extraction.
+METRIC_SINK = os.environ.get("METRIC_SINK", "cloudwatch")
+# EMF documents may hold up to 100 metrics, each with up to 100 values.
+MAX_EMF_METRICS = 100
+MAX_EMF_VALUES = 100
+# Seconds a replica's num or offset counts towards the cluster head that the
+# others are measured against.
+CLUSTER_HEAD_TTL = int(os.environ.get("CLUSTER_HEAD_TTL", 300))
+
+# The highest num and offset any replica has reported, by field, as (value,
+# log timestamp in ms). Kept while the Lambda container stays warm, so each
+# replica is compared with the others' recent reports, not only its own.
+clusterHeads = {}
+
+# A single scan over a log line picks out every field the handlers turn into
+# metrics. Every field starts at a space, which keeps the scan on the regex
+# engine's fast literal-prefix path and stops keys such as "usage=" from
+# matching "age=". m.lastindex identifies the alternative that matched.
+LOG_FIELD_RE = re.compile(
+    r" (?:(num|number|offset|peersTracked|peersEvicted)=(\d+)"    # 1, 2
+    r"|(blockAge|offsetAge|age|delta)=([\w.]*)"                   # 3, 4
+    r"|Serving (\d+) concurrent"                                  # 5
+    r"|(?<=peerCount: )(\d+)"                                     # 6
+    r"|(?<=blockNumber: )(\d+)"                                   # 7
+    r"|(Imported new chain segment"
+    r"|Error communicating with backend:"
+    r"|(?<=missing )trie node)"                                   # 8
+    r"|(worstPeerScore|medianPeerScore)=(\d+(?:[.]\d+)?))"        # 9, 10
+)
+FLAG_FIELDS = {
+    "Imported new chain segment": "imported",
+    "Error communicating with backend:": "backendError",
+    "trie node": "trieMissing",
+}
+LOG_FIELDS = [
+    "num", "number", "blockNumber", "offset", "blockAge", "offsetAge", "age",
+    "delta", "concurrency", "peerCount", "imported", "backendError",
+    "trieMissing", "peersTracked", "peersEvicted", "worstPeerScore",
+    "medianPeerScore",
+]
+LogFields = collections.namedtuple("LogFields", LOG_FIELDS)
+# peerManager's nodeTelemetry logs a JSON document after this prefix
+TELEMETRY_PREFIX = "telemetry: "
+
+DURATION_UNITS = "wdhms"
+DURATION_SECONDS = [60 * 60 * 24 * 7, 60 * 60 * 24, 60 * 60, 60, 1]
+
+
+def durationSeconds(text):
+    """
+    Parse a geth age such as "1h2m3s" into whole seconds. Units must appear in
+    order and parsing stops at the first unit that does not fit.
+    """
     ageSec = 0
-    week, day, hour, minute, second = m.groups()
-    if week:
-        ageSec += int(week[:-1]) * 60 * 60 * 24 * 7
-    if day:
-        ageSec += int(day[:-1]) * 60 * 60 * 24
-    if hour:
-        ageSec += int(hour[:-1]) * 60 * 60
-    if minute:
-        ageSec += int(minute[:-1]) * 60
-    if second:
-        ageSec += int(second[:-1])
+    last = -1
+    pos = 0
+    end = len(text)
+    while pos < end:
+        start = pos
+        while pos < end and "0" <= text[pos] <= "9":
+            pos += 1
+        if pos == start or pos == end:
+            break
+        unit = DURATION_UNITS.find(text[pos])
+        if unit <= last:
+            break
+        ageSec += int(text[start:pos]) * DURATION_SECONDS[unit]
+        last = unit
+        pos += 1
     return ageSec
 
 
-def ageFromReMs(message, regex):
-    m = regex.search(message)
-    if not m:
-        raise ValueError("Message does not match regex")
+def durationMs(text):
+    r"""
+    Parse a geth duration such as "1m2.5s" or "350.2ms" into milliseconds.
+    Accepts the same grammar as delta=(\d+w)?(\d+d)?(\d+h)?(\d+m(?!s))?
+    (\d+(?:[.]\d+)?s)?(\d+(?:[.]\d+)?ms)?, where only seconds and
+    milliseconds may be fractional.
+    """
     ageMs = 0
-    week, day, hour, minute, second, millis = m.groups()
-    if week:
-        ageMs += int(week[:-1]) * 60 * 60 * 24 * 7 * 1000
-    if day:
-        ageMs += int(day[:-1]) * 60 * 60 * 24 * 1000
-    if hour:
-        ageMs += int(hour[:-1]) * 60 * 60 * 1000
-    if minute:
-        ageMs += int(minute[:-1]) * 60 * 1000
-    if second:
-        ageMs += float(second[:-1]) * 1000
-    if millis:
-        ageMs += float(millis[:-2])
+    last = -1
+    pos = 0
+    end = len(text)
+    while pos < end:
+        start = pos
+        while pos < end and "0" <= text[pos] <= "9":
+            pos += 1
+        if pos == start or pos == end:
+            break
+        fractional = False
+        if text[pos] == "." and pos + 1 < end and "0" <= text[pos + 1] <= "9":
+            fractional = True
+            pos += 1
+            while pos < end and "0" <= text[pos] <= "9":
+                pos += 1
+            if pos == end:
+                break
+        if text[pos] == "m" and text[pos + 1:pos + 2] == "s":
+            unit = 5
+        else:
+            unit = DURATION_UNITS.find(text[pos])
+        if unit <= last or (fractional and unit < 4):
+            break
+        if unit == 5:
+            ageMs += float(text[start:pos])
+            pos += 2
+        elif unit == 4:
+            ageMs += float(text[start:pos]) * 1000
+            pos += 1
+        else:
+            ageMs += int(text[start:pos]) * DURATION_SECONDS[unit] * 1000
+            pos += 1
+        last = unit
     return ageMs
 
 
-def appendMetric(item, metricData, metricName, value, unit="None", stream=None):
+def parseLogLine(message):
+    """
+    Extract every metric field from a log message in one pass. Fields that do
+    not appear in the message are None; where a field appears more than once
+    the first occurrence wins.
+    """
+    values = {}
+    for m in LOG_FIELD_RE.finditer(message):
+        index = m.lastindex
+        if index == 2:
+            key, value = m.group(1), int(m.group(2))
+        elif index == 4:
+            key = m.group(3)
+            if key == "delta":
+                value = durationMs(m.group(4))
+            else:
+                value = durationSeconds(m.group(4))
+        elif index == 5:
+            key, value = "concurrency", int(m.group(5))
+        elif index == 6:
+            key, value = "peerCount", int(m.group(6))
+        elif index == 7:
+            key, value = "blockNumber", int(m.group(7))
+        elif index == 8:
+            key, value = FLAG_FIELDS[m.group(8)], True
+        else:
+            key, value = m.group(9), float(m.group(10))
+        if key not in values:
+            values[key] = value
+    return LogFields._make(map(values.get, LOG_FIELDS))
+
+
+def parseTelemetry(message):
+    """
+    Returns the document of a peerManager telemetry line as a dict, or None if
+    the message isn't one. The message may be the log line itself or the
+    journald record wrapping it.
+    """
+    start = message.find(TELEMETRY_PREFIX)
+    if start < 0:
+        return None
+    try:
+        if message.startswith("{"):
+            message = json.loads(message).get("message", "")
+            start = message.find(TELEMETRY_PREFIX)
+            if start < 0:
+                return None
+        document = json.loads(message[start + len(TELEMETRY_PREFIX):])
+    except ValueError:
+        return None
+    return document if isinstance(document, dict) else None
+
+
+WHITESPACE_RE = re.compile(r"[ \t\r\n]*")
+VALUE_DELIMITERS = set(",:]} \t\r\n")
+
+
+class LogEventStream(object):
+    """
+    Incrementally decodes a CloudWatch Logs subscription payload (base64
+    encoded, gzipped JSON), yielding its logEvents one at a time. Only a few
+    chunks of the payload are decoded at any point, so memory use does not
+    grow with the size of the batch.
+
+    The fields preceding logEvents (CloudWatch sends logStream and the rest
+    first) are available in `header` before iteration starts. Should
+    logStream come after the events, they are buffered so the header is
+    complete before the first event is yielded.
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, data, chunkSize=DECODE_CHUNK_SIZE):
+        self.data = data
+        self.chunkSize = chunkSize - chunkSize % 4
+        self.offset = 0
+        self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.text = codecs.getincrementaldecoder("utf8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.header = {}
+        self.inEvents = False
+        self.buffered = None
+        self.skipWhitespace()
+        self.expect("{")
+        self.readHeader()
+        if self.inEvents and "logStream" not in self.header:
+            self.buffered = list(self.readEvents())
+
+    def __iter__(self):
+        if self.buffered is not None:
+            events, self.buffered = self.buffered, None
+            return iter(events)
+        return self.readEvents()
+
+    def fill(self):
+        if self.eof:
+            return False
+        if self.inflater.unconsumed_tail:
+            chunk = self.inflater.decompress(self.inflater.unconsumed_tail,
+                                             self.chunkSize)
+        elif self.offset < len(self.data):
+            chunk = self.inflater.decompress(base64.b64decode(
+                self.data[self.offset:self.offset + self.chunkSize]
+            ), self.chunkSize)
+            self.offset += self.chunkSize
+        else:
+            chunk = self.inflater.flush()
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + self.text.decode(chunk, self.eof)
+        self.pos = 0
+        return True
+
+    def skipWhitespace(self):
+        while True:
+            self.pos = WHITESPACE_RE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                return
+
+    def expect(self, char):
+        self.skipWhitespace()
+        if self.buffer[self.pos:self.pos + 1] != char:
+            raise ValueError("Expected %r at offset %s of log payload" % (char, self.pos))
+        self.pos += 1
+
+    def peek(self):
+        self.skipWhitespace()
+        return self.buffer[self.pos:self.pos + 1]
+
+    def value(self):
+        self.skipWhitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            # Valid JSON values are always followed by a delimiter; without
+            # one, a number such as "12." may continue in the next chunk.
+            if self.buffer[end:end + 1] in VALUE_DELIMITERS or not self.fill():
+                self.pos = end
+                return value
+
+    def readHeader(self):
+        while self.peek() not in ("}", ""):
+            key = self.value()
+            self.expect(":")
+            if key == "logEvents":
+                self.expect("[")
+                self.inEvents = True
+                return
+            self.header[key] = self.value()
+            if self.peek() == ",":
+                self.pos += 1
+        self.inEvents = False
+
+    def readEvents(self):
+        decode = self.decoder.raw_decode
+        skip = WHITESPACE_RE.match
+        while self.inEvents:
+            # Fast path: decode the events already complete in the buffer
+            # without going through the general purpose helpers.
+            buffer, pos = self.buffer, self.pos
+            while True:
+                pos = skip(buffer, pos).end()
+                if buffer[pos:pos + 1] == ",":
+                    pos = skip(buffer, pos + 1).end()
+                if buffer[pos:pos + 1] != "{":
+                    break
+                try:
+                    value, end = decode(buffer, pos)
+                except ValueError:
+                    break
+                if buffer[end:end + 1] not in VALUE_DELIMITERS:
+                    break
+                self.pos = pos = end
+                yield value
+            self.pos = pos
+            char = self.peek()
+            if char == "]":
+                self.pos += 1
+                if self.peek() == ",":
+                    self.pos += 1
+                self.readHeader()
+                return
+            if char == ",":
+                # The fast path stopped before a separator that only arrived
+                # with the next chunk.
+                self.pos += 1
+                continue
+            yield self.value()
+
+
+def metricDimensions(stream=None):
     dimensions = [
         {
             'Name': 'clusterId',
@@ -78,127 +345,255 @@ def appendMetric(item, metricData, metricName, value, unit="None", stream=None):
             'Name': 'instanceId',
             'Value': stream
         })
-    metricData.append({
-        'MetricName': metricName,
-        'Dimensions': dimensions,
-        'Timestamp': datetime.datetime.utcfromtimestamp(
-            item["timestamp"] / 1000
-        ),
-        'Value': value,
-        'Unit': unit,
-    })
+    return dimensions
 
 
+class MetricAggregator(object):
+    """
+    Groups datapoints by metric, dimensions, unit and timestamp bucket, so each
+    group is sent as a single datum. Groups with up to MAX_VALUES_PER_DATUM
+    distinct values are sent as Values/Counts, which keeps percentiles
+    available; larger groups are sent as StatisticValues.
+    """
+    def __init__(self, namespace, bucketSeconds=METRIC_BUCKET_SECONDS):
+        self.namespace = namespace
+        self.publisher = MetricPublisher(getClient("cloudwatch"), namespace)
+        self.bucketMs = max(bucketSeconds * 1000, 1)
+        self.groups = {}
+        self.datapoints = 0
+
+    def add(self, metricName, stream, timestamp, value, unit="None"):
+        key = (metricName, stream, unit,
+               timestamp - timestamp % self.bucketMs)
+        counts = self.groups.get(key)
+        if counts is None:
+            counts = self.groups[key] = {}
+        counts[value] = counts.get(value, 0) + 1
+        self.datapoints += 1
+
+    def flush(self):
+        for (metricName, stream, unit, bucket), counts in self.groups.items():
+            datum = {
+                'MetricName': metricName,
+                'Dimensions': metricDimensions(stream),
+                'Timestamp': datetime.datetime.utcfromtimestamp(bucket / 1000),
+                'Unit': unit,
+            }
+            if len(counts) <= MAX_VALUES_PER_DATUM:
+                datum['Values'] = list(counts.keys())
+                datum['Counts'] = list(counts.values())
+            else:
+                datum['StatisticValues'] = {
+                    'SampleCount': sum(counts.values()),
+                    'Sum': sum(v * c for v, c in counts.items()),
+                    'Minimum': min(counts),
+                    'Maximum': max(counts),
+                }
+            self.publisher.append(datum)
+        self.groups = {}
+        result = self.publisher.flush()
+        result["datapoints"] = self.datapoints
+        return result
+
+
+class EmfSink(object):
+    """
+    Writes datapoints as CloudWatch Embedded Metric Format documents, one per
+    timestamp and set of dimensions, leaving metric extraction to CloudWatch
+    Logs. Log events arrive in timestamp order, so documents are written as
+    soon as the timestamp moves on.
+    """
+    def __init__(self, namespace, out=None):
+        self.namespace = namespace
+        self.out = out or sys.stdout
+        self.timestamp = None
+        self.pending = {}
+        self.documents = 0
+        self.datapoints = 0
+
+    def add(self, metricName, stream, timestamp, value, unit="None"):
+        if timestamp != self.timestamp:
+            self.write()
+            self.timestamp = timestamp
+        metrics = self.pending.get(stream)
+        if metrics is None:
+            metrics = self.pending[stream] = {}
+        if metricName not in metrics:
+            metrics[metricName] = (unit, [])
+        metrics[metricName][1].append(value)
+        self.datapoints += 1
+
+    def write(self):
+        for stream, metrics in self.pending.items():
+            dimensions = {"clusterId": os.environ.get("CLUSTER_ID")}
+            if stream:
+                dimensions["instanceId"] = stream
+            longest = max(len(values) for unit, values in metrics.values())
+            for start in range(0, longest, MAX_EMF_VALUES):
+                names = [name for name, (unit, values) in metrics.items()
+                         if len(values) > start]
+                for i in range(0, len(names), MAX_EMF_METRICS):
+                    self.writeDocument(dimensions, metrics, start,
+                                       names[i:i + MAX_EMF_METRICS])
+        self.pending = {}
+
+    def writeDocument(self, dimensions, metrics, start, names):
+        document = dict(dimensions)
+        definitions = []
+        for name in names:
+            unit, values = metrics[name]
+            values = values[start:start + MAX_EMF_VALUES]
+            document[name] = values[0] if len(values) == 1 else values
+            definitions.append({"Name": name, "Unit": unit})
+        document["_aws"] = {
+            "Timestamp": self.timestamp,
+            "CloudWatchMetrics": [{
+                "Namespace": self.namespace,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": definitions,
+            }],
+        }
+        self.out.write(json.dumps(document) + "\n")
+        self.documents += 1
+
+    def flush(self):
+        self.write()
+        self.out.flush()
+        logger.info("Wrote %s EMF documents for %s with %s datapoints",
+                    self.documents, self.namespace, self.datapoints)
+        return {"documents": self.documents, "datapoints": self.datapoints}
+
+
+def getMetricSink(namespace):
+    """
+    Returns the destination for one invocation's datapoints, chosen by
+    METRIC_SINK. Sinks take datapoints with add(metricName, stream, timestamp,
+    value, unit) and send them with flush(), which returns a summary dict.
+    """
+    if METRIC_SINK == "emf":
+        return EmfSink(namespace)
+    return MetricAggregator(namespace)
+
+
+def appendMetric(item, metricData, metricName, value, unit="None", stream=None):
+    metricData.add(metricName, stream, item["timestamp"], value, unit)
+
+
+REPLICA_METRICS = [
+    # (field, metric name, unit)
+    ("num", "num", "None"),
+    ("blockAge", "age", "Seconds"),
+    ("offset", "offset", "None"),
+    ("offsetAge", "offsetAge", "Seconds"),
+    ("delta", "delta", "Milliseconds"),
+    ("concurrency", "concurrency", "None"),
+]
+# Replica fields compared against the cluster head, and the per-instance
+# metric for how far behind it each replica is
+CLUSTER_LAG_METRICS = [
+    ("num", "blocksBehindCluster"),
+    ("offset", "offsetBehindCluster"),
+]
+# Fields of peerManager's "peerScores:" summary, published under their own names
+MASTER_PEER_METRICS = [
+    "peersTracked", "peersEvicted", "worstPeerScore", "medianPeerScore",
+]
+TELEMETRY_METRICS = [
+    # (field, metric name, unit)
+    ("peerCount", "peerCount", "None"),
+    ("headNumber", "number", "None"),
+    ("headAge", "headAge", "Seconds"),
+    ("syncing", "syncing", "None"),
+    ("syncLag", "syncLag", "None"),
+    ("txpoolPending", "txpoolPending", "None"),
+    ("txpoolQueued", "txpoolQueued", "None"),
+    ("freezerBlocks", "freezerBlocks", "None"),
+]
+
+
+def clusterHead(field, value, timestamp):
+    """
+    Records a replica's value of field at timestamp (in ms), returning the
+    highest value reported by any replica within CLUSTER_HEAD_TTL seconds.
+    """
+    head = clusterHeads.get(field)
+    if head is None or value >= head[0] or timestamp - head[1] > CLUSTER_HEAD_TTL * 1000:
+        head = clusterHeads[field] = (value, timestamp)
+    return head[0]
+
+
+@profiled
 def masterHandler(event, context):
-    eventData = json.loads(gzip.decompress(base64.b64decode(
-        event["awslogs"]["data"])
-    ))
-    for item in eventData["logEvents"]:
-        metricData = []
-        try:
-            if "Imported new chain segment" in item["message"]:
-                appendMetric(item, metricData, "number",
-                             numberFromRe(item["message"], MASTER_BLOCK_NUM_RE))
+    timer = PhaseTimer("masterHandler")
+    with timer.phase("decode"):
+        logEvents = LogEventStream(event["awslogs"]["data"])
+    metricData = getMetricSink('BlockData')
+    with timer.phase("aggregate"):
+        for item in timer.timed("decode", logEvents):
+            with timer.phase("parse"):
+                telemetry = parseTelemetry(item["message"])
+            if telemetry is not None:
+                for field, metricName, unit in TELEMETRY_METRICS:
+                    value = telemetry.get(field)
+                    if isinstance(value, bool):
+                        value = int(value)
+                    if value is not None:
+                        appendMetric(item, metricData, metricName, value, unit)
+                continue
+            with timer.phase("parse"):
+                fields = parseLogLine(item["message"])
+            if fields.imported:
+                number = fields.number
             else:
-                appendMetric(item, metricData, "number",
-                             numberFromRe(item["message"], PEER_BLOCK_NUM_RE))
-        except ValueError:
-            pass
-        try:
-            appendMetric(item, metricData, "age",
-                         ageFromRe(item["message"], BLOCK_AGE_RE), "Seconds")
-        except ValueError:
-            pass
-        try:
-            appendMetric(item, metricData, "peerCount",
-                         numberFromRe(item["message"], PEER_COUNT_RE))
-        except ValueError:
-            pass
-
-        if len(metricData) >= 20:
-            client.put_metric_data(
-                Namespace='BlockData',
-                MetricData=metricData[:20]
-            )
-            metricData = metricData[20:]
-    if metricData:
-        client.put_metric_data(
-            Namespace='BlockData',
-            MetricData=metricData[:20]
-        )
+                number = fields.blockNumber
+            if number is not None:
+                appendMetric(item, metricData, "number", number)
+            if fields.age is not None:
+                appendMetric(item, metricData, "age", fields.age, "Seconds")
+            if fields.peerCount is not None:
+                appendMetric(item, metricData, "peerCount", fields.peerCount)
+            for field in MASTER_PEER_METRICS:
+                value = getattr(fields, field)
+                if value is not None:
+                    appendMetric(item, metricData, field, value)
+
+    with timer.phase("publish"):
+        result = metricData.flush()
+    result["phasesMs"] = timer.log()
+    return result
 
 
+@profiled
 def replicaHandler(event, context):
-    eventData = json.loads(gzip.decompress(base64.b64decode(
-        event["awslogs"]["data"])
-    ))
-    for item in eventData["logEvents"]:
-        metricData = []
-        try:
-            appendMetric(item, metricData, "num",
-                         numberFromRe(item["message"], BLOCK_NUM_REP_RE),
-                         stream=eventData["logStream"])
-            appendMetric(item, metricData, "num",
-                         numberFromRe(item["message"], BLOCK_NUM_REP_RE))
-        except ValueError:
-            pass
-        try:
-            appendMetric(item, metricData, "age",
-                         ageFromRe(item["message"], BLOCK_AGE_REP_RE),
-                         "Seconds", stream=eventData["logStream"])
-            appendMetric(item, metricData, "age",
-                         ageFromRe(item["message"], BLOCK_AGE_REP_RE),
-                         "Seconds")
-        except ValueError:
-            pass
-        try:
-            appendMetric(item, metricData, "offset",
-                         numberFromRe(item["message"], OFFSET_NUM_RE),
-                         stream=eventData["logStream"])
-            appendMetric(item, metricData, "offset",
-                         numberFromRe(item["message"], OFFSET_NUM_RE))
-        except ValueError:
-            pass
-        try:
-            appendMetric(item, metricData, "offsetAge",
-                         ageFromRe(item["message"], OFFSET_AGE_RE), "Seconds",
-                         stream=eventData["logStream"])
-            appendMetric(item, metricData, "offsetAge",
-                         ageFromRe(item["message"], OFFSET_AGE_RE), "Seconds")
-        except ValueError:
-            pass
-        try:
-            appendMetric(item, metricData, "delta",
-                         ageFromReMs(item["message"], DELTA_RE), "Milliseconds",
-                         stream=eventData["logStream"])
-            appendMetric(item, metricData, "delta",
-                         ageFromReMs(item["message"], DELTA_RE), "Milliseconds")
-        except ValueError:
-            pass
-        try:
-            appendMetric(item, metricData, "concurrency",
-                         numberFromRe(item["message"], CONCURRENCY_RE),
-                         stream=eventData["logStream"])
-            appendMetric(item, metricData, "concurrency",
-                         numberFromRe(item["message"], CONCURRENCY_RE))
-        except ValueError:
-            pass
-
-        if "Error communicating with backend:" in item["message"]:
-            appendMetric(item, metricData, "backend_error", 1,
-                         stream=eventData["logStream"])
-
-        if "missing trie node" in item["message"]:
-            appendMetric(item, metricData, "trieMissing", 1)
-
-        if len(metricData) >= 20:
-            client.put_metric_data(
-                Namespace='ReplicaData',
-                MetricData=metricData[:20]
-            )
-            metricData = metricData[20:]
-    if metricData:
-        client.put_metric_data(
-            Namespace='ReplicaData',
-            MetricData=metricData[:20]
-        )
+    timer = PhaseTimer("replicaHandler")
+    with timer.phase("decode"):
+        logEvents = LogEventStream(event["awslogs"]["data"])
+    metricData = getMetricSink('ReplicaData')
+    stream = logEvents.header["logStream"]
+    with timer.phase("aggregate"):
+        for item in timer.timed("decode", logEvents):
+            with timer.phase("parse"):
+                fields = parseLogLine(item["message"])
+            for field, metricName, unit in REPLICA_METRICS:
+                value = getattr(fields, field)
+                if value is not None:
+                    appendMetric(item, metricData, metricName, value, unit,
+                                 stream=stream)
+                    appendMetric(item, metricData, metricName, value, unit)
+
+            for field, metricName in CLUSTER_LAG_METRICS:
+                value = getattr(fields, field)
+                if value is not None:
+                    behind = clusterHead(field, value, item["timestamp"]) - value
+                    appendMetric(item, metricData, metricName, behind, stream=stream)
+
+            if fields.backendError:
+                appendMetric(item, metricData, "backend_error", 1, stream=stream)
+
+            if fields.trieMissing:
+                appendMetric(item, metricData, "trieMissing", 1)
+
+    with timer.phase("publish"):
+        result = metricData.flush()
+    result["phasesMs"] = timer.log()
+    return result
@@ -1,21 +1,203 @@
-import boto3
+import datetime
+import logging
+import math
 import os
+from awsUtils import MetricPublisher, getClient
 
-client = boto3.client("ec2")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
-def sizeHandler(event, context):
-    target_size = int(os.environ.get("VOLUME_SIZE"))
-    volumes = client.describe_volumes(Filters=[
+# Grow a volume once its filesystem is this full (per the CloudWatch agent's
+# disk_used_percent), by GROW_BY_PERCENT of its size. The default of 0 disables
+# growth based on usage, leaving only VOLUME_SIZE.
+GROW_AT_PERCENT = float(os.environ.get("GROW_AT_PERCENT", 0))
+GROW_BY_PERCENT = float(os.environ.get("GROW_BY_PERCENT", 20))
+MAX_VOLUME_SIZE = int(os.environ.get("MAX_VOLUME_SIZE", 16384))
+DISK_PATH = os.environ.get("DISK_PATH", "/var/lib/ethereum")
+# Run resize2fs over SSM as soon as a volume starts optimizing, rather than
+# waiting for the instances' resize2fs cron job
+GROW_FILESYSTEM = os.environ.get("GROW_FILESYSTEM", "").lower() in ("1", "true", "yes")
+METRIC_NAMESPACE = os.environ.get("METRIC_NAMESPACE", "VolumeData")
+# How often the handler runs, so each completed resize is reported once
+CHECK_INTERVAL = int(os.environ.get("CHECK_INTERVAL", 15 * 60))
+# EBS allows one modification per volume every six hours
+MODIFICATION_COOLDOWN = datetime.timedelta(hours=6)
+
+IN_PROGRESS = ("modifying", "optimizing")
+# Volume IDs per describe_volumes_modifications filter
+MODIFICATION_FILTER_SIZE = 200
+
+
+def listVolumes():
+    paginator = getClient("ec2").get_paginator("describe_volumes")
+    for page in paginator.paginate(Filters=[
         {"Name": "tag:Name", "Values": [os.environ.get("VOLUME_NAME")]},
-        {"Name":"attachment.device", "Values": [os.environ.get("ATTACHMENT_DEVICE")]}
-    ])["Volumes"]
+        {"Name": "attachment.device", "Values": [os.environ.get("ATTACHMENT_DEVICE")]}
+    ]):
+        for volume in page["Volumes"]:
+            yield volume
+
+
+def latestModifications(volumeIds):
+    """
+    Returns the most recent modification of each volume, by volume ID. Volumes
+    that were never modified are left out. They're selected with a volume-id
+    filter because listing them in VolumeIds fails the whole call if any of
+    them has never been modified.
+    """
+    modifications = {}
+    paginator = getClient("ec2").get_paginator("describe_volumes_modifications")
+    for i in range(0, len(volumeIds), MODIFICATION_FILTER_SIZE):
+        for page in paginator.paginate(Filters=[{
+            "Name": "volume-id", "Values": volumeIds[i:i + MODIFICATION_FILTER_SIZE],
+        }]):
+            for modification in page["VolumesModifications"]:
+                if not modification.get("ModificationState") or not modification.get("StartTime"):
+                    continue
+                latest = modifications.get(modification["VolumeId"])
+                if latest is None or modification["StartTime"] > latest["StartTime"]:
+                    modifications[modification["VolumeId"]] = modification
+    return modifications
+
+
+def diskUsedPercent(volumes, now):
+    """
+    Returns the latest disk_used_percent for DISK_PATH on each volume's
+    instance, by volume ID, in a single get_metric_data call.
+
+    The stack's agent config appends an AutoScalingGroupName dimension, which
+    stops the agent from publishing a host dimension, so usage can only be
+    told apart by Auto Scaling group. Each volume gets the fullest disk in its
+    instance's group; the masters in a group hold the same chain, so their
+    usage barely differs. Volumes on instances outside a group, such as the
+    snapshot volume, have no usage and only follow VOLUME_SIZE.
+    """
+    instanceIds = set(
+        a["InstanceId"] for v in volumes for a in v.get("Attachments", []))
+    if not instanceIds:
+        return {}
+    groups = {}
+    for reservation in getClient("ec2").describe_instances(InstanceIds=list(instanceIds))["Reservations"]:
+        for instance in reservation["Instances"]:
+            for tag in instance.get("Tags", []):
+                if tag["Key"] == "aws:autoscaling:groupName":
+                    groups[instance["InstanceId"]] = tag["Value"]
+    queries = []
+    for i, group in enumerate(sorted(set(groups.values()))):
+        queries.append({
+            "Id": "g%d" % i,
+            "Label": group,
+            "Expression": "SEARCH('Namespace=\"CWAgent\" MetricName=\"disk_used_percent\" "
+                          "path=\"%s\" AutoScalingGroupName=\"%s\"', 'Maximum', 300)"
+                          % (DISK_PATH, group),
+        })
+    if not queries:
+        return {}
+    groupUsage = {}
+    for result in getClient("cloudwatch").get_metric_data(
+        MetricDataQueries=queries,
+        StartTime=now - datetime.timedelta(minutes=15),
+        EndTime=now,
+        ScanBy="TimestampDescending",
+    )["MetricDataResults"]:
+        query = next(q for q in queries if result["Id"] == q["Id"])
+        if result["Values"]:
+            groupUsage[query["Label"]] = max(groupUsage.get(query["Label"], 0), result["Values"][0])
+    usage = {}
+    for volume in volumes:
+        for attachment in volume.get("Attachments", []):
+            group = groups.get(attachment["InstanceId"])
+            if group in groupUsage:
+                usage[volume["VolumeId"]] = groupUsage[group]
+    return usage
+
+
+def targetSize(volume, usedPercent, staticTarget):
+    """
+    The size a volume should grow to: at least staticTarget, and GROW_BY_PERCENT
+    larger once it is GROW_AT_PERCENT full, capped at MAX_VOLUME_SIZE.
+    """
+    target = staticTarget
+    if GROW_AT_PERCENT and usedPercent is not None and usedPercent >= GROW_AT_PERCENT:
+        target = max(target, int(math.ceil(volume["Size"] * (1 + GROW_BY_PERCENT / 100.0))))
+    return min(target, MAX_VOLUME_SIZE)
+
+
+def growFilesystem(volume):
+    instanceIds = [a["InstanceId"] for a in volume.get("Attachments", [])]
+    if not instanceIds:
+        return
+    try:
+        getClient("ssm").send_command(
+            InstanceIds=instanceIds,
+            DocumentName="AWS-RunShellScript",
+            Parameters={"commands": ["resize2fs $(readlink -f %s)" % os.environ.get("ATTACHMENT_DEVICE")]},
+        )
+    except Exception as e:
+        logger.warning("Could not grow the filesystem on %s: %s", instanceIds, e)
+
+
+def sizeHandler(event, context):
+    """
+    Grows master volumes one at a time. A volume is only modified once no
+    other volume is still modifying or optimizing, so at most one master pays
+    the optimization I/O penalty at once, with the fullest volume going first.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    target_size = int(os.environ.get("VOLUME_SIZE") or 0)
+    volumes = list(listVolumes())
+    modifications = latestModifications([v["VolumeId"] for v in volumes])
+    publisher = MetricPublisher(getClient("cloudwatch"), METRIC_NAMESPACE)
+    dimensions = [{"Name": "VolumeName", "Value": os.environ.get("VOLUME_NAME")}]
+    busy = []
     for volume in volumes:
-        if volume["Size"] < target_size:
-            client.modify_volume(
-                VolumeId = volume["VolumeId"],
-                Size = target_size,
+        modification = modifications.get(volume["VolumeId"])
+        if modification is None:
+            continue
+        state = modification.get("ModificationState")
+        if state in IN_PROGRESS:
+            busy.append(volume["VolumeId"])
+            if state == "optimizing" and GROW_FILESYSTEM:
+                growFilesystem(volume)
+        elif state == "completed" and modification.get("EndTime") and \
+                now - modification["EndTime"] <= datetime.timedelta(seconds=CHECK_INTERVAL):
+            duration = (modification["EndTime"] - modification["StartTime"]).total_seconds()
+            logger.info("Resize of %s to %sGiB took %.0fs", volume["VolumeId"],
+                        modification.get("TargetSize"), duration)
+            publisher.append({
+                'MetricName': "VolumeResizeDuration",
+                'Dimensions': dimensions,
+                'Timestamp': modification["EndTime"],
+                'Value': duration,
+                'Unit': "Seconds",
+            })
+        elif state == "failed":
+            logger.warning("Resize of %s failed: %s", volume["VolumeId"],
+                           modification.get("StatusMessage"))
+    result = {"volumes": len(volumes), "busy": busy, "resized": None}
+    if busy:
+        logger.info("Waiting for %s to finish before resizing another volume", busy)
+    else:
+        usage = diskUsedPercent(volumes, now) if GROW_AT_PERCENT else {}
+        candidates = []
+        for volume in volumes:
+            modification = modifications.get(volume["VolumeId"])
+            if modification is not None and now - modification["StartTime"] < MODIFICATION_COOLDOWN:
+                continue
+            size = targetSize(volume, usage.get(volume["VolumeId"]), target_size)
+            if size > volume["Size"]:
+                candidates.append((-usage.get(volume["VolumeId"], 0), volume["VolumeId"], size))
+        if candidates:
+            _, volumeId, size = min(candidates)
+            logger.info("Resizing %s to %sGiB (%.0f%% used)", volumeId, size,
+                        usage.get(volumeId, 0))
+            getClient("ec2").modify_volume(
+                VolumeId=volumeId,
+                Size=size,
             )
-            break # Only do one at a time to avoid the optimizing performance penalties hitting all masters at once
+            result["resized"] = {"volumeId": volumeId, "size": size}
+    result["metrics"] = publisher.flush()
+    return result
 
 
 # TODO: Upload
@@ -3,136 +3,940 @@
 """
 This script connects different masters controlled by the same organization.
 
-When the script starts up, it sends its connectivity information to a Kafka
-topic. It then follows the Kafka topic (from the earliest available records)
-establishing all peers listed on the Kafka topic as trusted peers and attempting
-to connect to them.
+When the script starts up, it sends its connectivity information to a
+compacted Kafka registry topic ("<topic>-registry"), keyed by node ID, and
+repeats it as a heartbeat while it runs. It then follows the registry topic
+(from the earliest available records) establishing all peers listed on it as
+trusted peers and attempting to connect to them, and removes peers whose
+heartbeats stop. Unless --no-legacy-registration is given it also registers
+once on <topic> itself in the old unkeyed format, so masters still running an
+older peerManager keep connecting to it during a rolling upgrade.
+
+Alongside that it periodically checks the health of its external peers, scoring
+them on how well they keep up with the chain and evicting the worst when geth
+nears --maxpeers, and logs a JSON telemetry line describing the node for
+logMonitor. The loops run as threads of one process sharing a single IPC
+connection, and exit cleanly on SIGTERM or SIGINT.
 """
 
+import collections
+import itertools
 import json
 import kafka
+import re
+import signal
 import socket
-import random
+import sys
+import threading
 import time
 import logging
+import six
 from six.moves.urllib.parse import unquote_plus
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+IPC_TIMEOUT = 30
+RECONNECT_MIN_DELAY = 0.1
+RECONNECT_MAX_DELAY = 10
+POLL_TIMEOUT_MS = 1000
+POLL_MAX_RECORDS = 5000
+PEER_BATCH_SIZE = 250
+HEARTBEAT_INTERVAL = 60
+PEER_TTL = 300
+# externalPeerManager checks peer health every BEHIND_INTERVAL seconds while
+# the master is behind its best peer. Once synced it checks on new heads, at
+# most every SYNCED_INTERVAL seconds and at least every IDLE_INTERVAL.
+BEHIND_INTERVAL = 5
+SYNCED_INTERVAL = 30
+IDLE_INTERVAL = 120
+MAX_PEERS = 25
+# Observations of each external peer kept for scoring
+PEER_HISTORY = 30
+# Observations needed before a peer can be evicted
+MIN_OBSERVATIONS = 3
+# Peers are at the head when within this fraction of the best total difficulty
+HEAD_TOLERANCE = 0.9999
+# Peers behind the head with no progress for this many observations are dropped
+STALL_OBSERVATIONS = 10
+# Once the external peers are within EVICTION_HEADROOM of --maxpeers, up to
+# MAX_EVICTIONS peers scoring below EVICTION_SCORE are dropped per poll to make
+# room for better ones.
+EVICTION_HEADROOM = 2
+EVICTION_SCORE = 0.5
+MAX_EVICTIONS = 2
+# Seconds between nodeTelemetry samples. 0 disables telemetry.
+TELEMETRY_INTERVAL = 10
+TELEMETRY_SCHEMA = 1
+SHUTDOWN_TIMEOUT = 10
+REGISTRY_TOPIC_SUFFIX = "-registry"
+# Compaction only cleans closed segments, so roll them hourly rather than
+# weekly, and keep tombstones long enough for a booting master to replay them.
+REGISTRY_TOPIC_CONFIGS = {
+    "compression.type": "gzip",
+    "cleanup.policy": "compact",
+    "segment.ms": "3600000",
+    "min.cleanable.dirty.ratio": "0.1",
+    "delete.retention.ms": "3600000",
+}
 
-class IPCBackend(object):
-    def __init__(self, path):
+
+class IPCError(Exception):
+    pass
+
+
+class IPCTimeout(IPCError):
+    pass
+
+
+class JSONFramer(object):
+    """
+    Splits a byte stream into complete top level JSON values (objects, or
+    arrays for batch responses). Scanning resumes where the previous feed()
+    stopped, so each byte is examined once no matter how many recv() calls a
+    response spans.
+    """
+    TOKEN_RE = re.compile(br'(")|(\\)|([{\[])|([}\]])')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.start = 0
+        self.depth = 0
+        self.inString = False
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        buffer = self.buffer
+        messages = []
+        pos = self.pos
         while True:
+            m = self.TOKEN_RE.search(buffer, pos)
+            if not m:
+                pos = max(pos, len(buffer))
+                break
+            token = m.lastindex
+            pos = m.end()
+            if self.inString:
+                if token == 2:
+                    pos += 1  # Skip the escaped character
+                elif token == 1:
+                    self.inString = False
+            elif token == 1:
+                self.inString = True
+            elif token == 3:
+                if self.depth == 0:
+                    self.start = m.start()
+                self.depth += 1
+            elif token == 4 and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    messages.append(bytes(buffer[self.start:pos]))
+        # Drop everything that can no longer be part of a message
+        consumed = self.start if self.depth else min(pos, len(buffer))
+        del buffer[:consumed]
+        self.pos = pos - consumed
+        self.start -= min(self.start, consumed)
+        return messages
+
+    def reset(self):
+        self.__init__()
+
+
+class Pending(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+    def resolve(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout):
+        if not self.event.wait(timeout):
+            raise IPCTimeout("No response after %.1fs" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class IPCBackend(object):
+    """
+    JSON-RPC client for geth's IPC socket. A single connection is shared by
+    any number of threads: requests are tagged with unique IDs and a reader
+    thread matches responses back to their callers, so several calls can be in
+    flight at once. If the connection drops, outstanding calls fail with
+    IPCError and the reader reconnects with exponential backoff.
+
+    Subscriptions made with subscribe() have their notifications passed to a
+    callback on the reader thread, and are renewed after a reconnect.
+    """
+    def __init__(self, path, timeout=IPC_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.subscriptions = []
+        self.callbacks = {}
+        self.lock = threading.Lock()
+        self.sendLock = threading.Lock()
+        self.connected = threading.Event()
+        self.closed = False
+        self.s = None
+        self.connect()
+        self.reader = threading.Thread(target=self.readLoop, name="ipc-reader")
+        self.reader.daemon = True
+        self.reader.start()
+
+    def connect(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self.closed:
+            s = socket.socket(socket.AF_UNIX)
             try:
-                self.s = socket.socket(socket.AF_UNIX)
-                self.s.connect(path)
+                s.connect(self.path)
             except socket.error:
-                # Wait for socket to become avaialble
-                pass
+                # Wait for socket to become available
+                s.close()
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
             else:
-                break
-    def get(self, method, params=None):
+                self.s = s
+                self.connected.set()
+                return
+
+    def readLoop(self):
+        framer = JSONFramer()
+        while not self.closed:
+            try:
+                data = self.s.recv(65536)
+            except socket.error:
+                data = b""
+            if not data:
+                if self.closed:
+                    return
+                logger.warning("Lost IPC connection to %s, reconnecting", self.path)
+                self.connected.clear()
+                self.failPending(IPCError("IPC connection lost"))
+                self.s.close()
+                framer.reset()
+                self.connect()
+                if self.subscriptions:
+                    # Renewing needs the reader thread to handle the responses
+                    renew = threading.Thread(target=self.renewSubscriptions)
+                    renew.daemon = True
+                    renew.start()
+                continue
+            for message in framer.feed(data):
+                try:
+                    payload = json.loads(message.decode("utf8"))
+                except ValueError:
+                    logger.warning("Unexpected JSON payload: '%s'", message)
+                    continue
+                self.dispatch(payload)
+
+    def dispatch(self, payload):
+        for response in payload if isinstance(payload, list) else [payload]:
+            if response.get("method") == "eth_subscription":
+                params = response.get("params", {})
+                callback = self.callbacks.get(params.get("subscription"))
+                if callback is not None:
+                    try:
+                        callback(params.get("result"))
+                    except Exception:
+                        logger.exception("Subscription callback failed")
+                continue
+            with self.lock:
+                pending = self.pending.pop(response.get("id"), None)
+            if pending is not None:
+                pending.resolve(response)
+
+    def failPending(self, error):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for p in pending.values():
+            p.resolve(error=error)
+
+    def send(self, requests, timeout):
+        if not self.connected.wait(timeout):
+            raise IPCTimeout("Not connected to %s after %ss" % (self.path, timeout))
+        waiting = []
+        with self.lock:
+            for request in requests:
+                p = Pending()
+                self.pending[request["id"]] = p
+                waiting.append((request["id"], p))
+        payload = requests[0] if len(requests) == 1 else requests
+        try:
+            with self.sendLock:
+                self.s.sendall(json.dumps(payload).encode("utf8"))
+        except socket.error as e:
+            self.forget(waiting)
+            raise IPCError("Failed to send request: %s" % e)
+        deadline = time.time() + timeout
+        try:
+            return [p.wait(max(deadline - time.time(), 0)) for _, p in waiting]
+        finally:
+            self.forget(waiting)
+
+    def forget(self, waiting):
+        with self.lock:
+            for id, _ in waiting:
+                self.pending.pop(id, None)
+
+    def request(self, method, params=None):
         if params is None:
             params = []
-        id = random.randint(0, 4096)
-        self.s.send(json.dumps({
+        return {
             "jsonrpc": "2.0",
             "method": method,
             "params": params,
-            "id": id
-        }).encode("utf8"))
-        response = ""
-        while True:
-            response += self.s.recv(16192)
+            "id": next(self.ids),
+        }
+
+    def get(self, method, params=None, timeout=None):
+        """Sends a single request, returning the full JSON-RPC response"""
+        return self.send([self.request(method, params)], timeout or self.timeout)[0]
+
+    def batch(self, calls, timeout=None):
+        """
+        Sends a list of (method, params) pairs as one JSON-RPC batch, returning
+        the responses in the same order.
+        """
+        if not calls:
+            return []
+        return self.send([self.request(method, params) for method, params in calls],
+                         timeout or self.timeout)
+
+    def subscribe(self, callback, *params):
+        """
+        Starts an eth_subscribe subscription, such as subscribe(f, "newHeads"),
+        calling callback with the result of each notification. Callbacks run
+        on the reader thread, so they should return quickly.
+        """
+        subscription = (params, callback)
+        self.renew(subscription)
+        self.subscriptions.append(subscription)
+
+    def renew(self, subscription):
+        params, callback = subscription
+        response = self.get("eth_subscribe", list(params))
+        if "error" in response:
+            raise IPCError("eth_subscribe %s failed: %s" % (params, response["error"]))
+        self.callbacks[response["result"]] = callback
+
+    def renewSubscriptions(self):
+        self.callbacks = {}
+        for subscription in self.subscriptions:
             try:
-                res = json.loads(response)
-            except ValueError:
-                logger.warning("Unexpected JSON payload: '%s'", response)
+                self.renew(subscription)
+            except IPCError as e:
+                logger.warning("Could not renew subscription: %s", e)
+
+    def close(self):
+        self.closed = True
+        self.connected.set()
+        if self.s is not None:
+            try:
+                self.s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
                 pass
+            self.s.close()
+        self.failPending(IPCError("IPC client closed"))
+
+
+def nodeId(enode):
+    """The enode URL without its address, identifying the node across restarts"""
+    return enode.split("@")[0]
+
+
+def addTrustedPeers(backend, enodes):
+    """
+    Adds each enode as a trusted peer and dials it, sending the calls as
+    JSON-RPC batches of up to PEER_BATCH_SIZE peers. Returns the number of
+    peers added without error.
+    """
+    return applyPeerCalls(backend, enodes, ("admin_addTrustedPeer", "admin_addPeer"), "Added %s as trusted peer")
+
+
+def removeTrustedPeers(backend, enodes):
+    """
+    Removes each enode from the trusted peers and disconnects it, batched like
+    addTrustedPeers. Returns the number of peers removed without error.
+    """
+    return applyPeerCalls(backend, enodes, ("admin_removeTrustedPeer", "admin_removePeer"), "Removed trusted peer %s")
+
+
+def applyPeerCalls(backend, enodes, methods, message):
+    done = 0
+    for i in range(0, len(enodes), PEER_BATCH_SIZE):
+        chunk = enodes[i:i + PEER_BATCH_SIZE]
+        calls = [(method, [enode]) for enode in chunk for method in methods]
+        responses = backend.batch(calls)
+        n = len(methods)
+        for j, enode in enumerate(chunk):
+            errors = [r["error"] for r in responses[n * j:n * (j + 1)] if "error" in r]
+            if errors:
+                logger.warning("%s failed for %s: %s", "/".join(methods), enode, errors)
             else:
-                break
-        if res["id"] != id:
-            raise Exception("Got unexpected ID")
-        return res
+                logger.info(message, enode)
+                done += 1
+    return done
+
+
+def parseRegistration(msg):
+    """
+    Returns (node ID, enode, heartbeat timestamp) for a record on the registry
+    topic. Records are keyed by node ID with a JSON value of
+    {"enode": ..., "ts": ...}; a null value is a tombstone, returned with an
+    enode of None.
+    """
+    if msg.value is None:
+        if msg.key is None:
+            return None
+        return msg.key.decode("utf8"), None, None
+    value = msg.value.decode("utf8")
+    try:
+        record = json.loads(value)
+        return nodeId(record["enode"]), record["enode"], float(record["ts"])
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Unexpected registration on registry topic: %s", value)
+        return None
 
 
-def trustedPeerManager(path, broker_config, topic):
-    backend = IPCBackend(path)
+class PeerRegistry(object):
+    """
+    Tracks the masters registered on the registry topic by node ID, with the time
+    of each one's latest heartbeat. Registrations are collected with observe()
+    and applied to geth in batches by apply(), which also drops peers whose
+    heartbeat is older than the TTL, so the peer table only holds live masters.
+    Peers still silent after twice the TTL are handed out once by expired(), to
+    be tombstoned so compaction can forget them.
+    """
+    def __init__(self, myId, ttl=PEER_TTL):
+        self.myId = myId
+        self.ttl = ttl
+        self.peers = {}
+        self.observed = {}
+        # Latest heartbeat of each peer that has lapsed, by node ID
+        self.lapsed = {}
+
+    def observe(self, msg):
+        registration = parseRegistration(msg)
+        if registration is not None and registration[0] != self.myId:
+            self.observed[registration[0]] = registration[1:]
+
+    def apply(self, backend, now=None):
+        """
+        Applies the registrations observed since the last call, returning the
+        number of peers added and removed.
+        """
+        if now is None:
+            now = time.time()
+        expiry = now - self.ttl
+        add, remove = [], []
+        for id, (enode, ts) in self.observed.items():
+            current = self.peers.get(id)
+            if enode is None or ts < expiry:
+                # Tombstones, and registrations that went stale before we saw
+                # them, only matter for peers we're connected to.
+                if current is not None and (enode is None or enode == current["enode"]):
+                    remove.append(current["enode"])
+                    del self.peers[id]
+                if enode is None:
+                    self.lapsed.pop(id, None)
+                else:
+                    self.lapsed[id] = ts
+                continue
+            self.lapsed.pop(id, None)
+            if current is not None and current["enode"] != enode:
+                remove.append(current["enode"])
+            if current is None or current["enode"] != enode:
+                add.append(enode)
+            self.peers[id] = {"enode": enode, "ts": ts}
+        self.observed = {}
+        for id, peer in list(self.peers.items()):
+            if peer["ts"] < expiry:
+                logger.info("No heartbeat from %s in %.0fs", peer["enode"], now - peer["ts"])
+                remove.append(peer["enode"])
+                del self.peers[id]
+                self.lapsed[id] = peer["ts"]
+        removed = removeTrustedPeers(backend, remove)
+        added = addTrustedPeers(backend, add)
+        return added, removed
+
+    def expired(self, now=None):
+        """
+        Returns the IDs of peers whose last heartbeat is more than twice the TTL
+        old, forgetting them. If one is still alive after all, its next
+        heartbeat registers it again.
+        """
+        if now is None:
+            now = time.time()
+        expiry = now - 2 * self.ttl
+        ids = [id for id, ts in self.lapsed.items() if ts < expiry]
+        for id in ids:
+            del self.lapsed[id]
+        return ids
+
+
+def trustedPeerManager(backend, broker_config, topic, stop,
+                       heartbeatInterval=HEARTBEAT_INTERVAL, peerTTL=PEER_TTL,
+                       legacyRegistration=True):
+    start = time.time()
+    registry = topic + REGISTRY_TOPIC_SUFFIX
     admin = kafka.KafkaAdminClient(**broker_config)
+    # We can't rely on auto-creating the topics, because they will default to
+    # snappy compression, which Python doesn't natively support and we
+    # don't want to mess with setting up. Compaction keeps only the latest
+    # record for each node ID, so replaying the registry costs the same however
+    # many masters have come and gone.
     try:
-        # We can't rely on auto-creating the topic, because it will default to
-        # snappy compression, which Python doesn't natively support and we
-        # don't want to mess with setting up
         admin.create_topics([
-            kafka.admin.NewTopic(topic, 1, 3,
-                                 topic_configs={"compression.type": "gzip"})
+            kafka.admin.NewTopic(registry, 1, 3, topic_configs=REGISTRY_TOPIC_CONFIGS)
         ])
     except kafka.errors.TopicAlreadyExistsError:
-        pass
-    consumer = kafka.KafkaConsumer(topic, auto_offset_reset='earliest', **broker_config)
+        # alter_configs replaces the topic's whole config, so pass everything.
+        try:
+            admin.alter_configs([
+                kafka.admin.ConfigResource(kafka.admin.ConfigResourceType.TOPIC,
+                                           registry, configs=REGISTRY_TOPIC_CONFIGS)
+            ])
+        except Exception as e:
+            logger.warning("Could not update the config of %s: %s", registry, e)
+    consumer = kafka.KafkaConsumer(registry, auto_offset_reset='earliest', **broker_config)
     producer = kafka.KafkaProducer(**broker_config)
     myIp = socket.gethostbyname(socket.gethostname())
     node_info = backend.get("admin_nodeInfo")["result"]
     enode = node_info["enode"]
-    internal_enode = "%s@%s:30303" % (enode.split("@")[0], myIp)
-    producer.send(topic, internal_enode.encode("utf8"))
-    logger.info("Registered with %s as %s", topic, internal_enode)
-    registered = set([internal_enode])
-    for msg in consumer:
-        peer = msg.value.decode("utf8")
-        if peer not in registered:
-            backend.get("admin_addTrustedPeer", [peer])
-            backend.get("admin_addPeer", [peer])
-            logger.info("Added %s as trusted peer", peer)
-        registered.add(peer)
-
-def externalPeerManager(path):
-    backend = IPCBackend(path)
-    peers = {}
-    while True:
-        block_number = backend.get("eth_blockNumber")["result"]
-        logger.info("blockNumber: %s" % int(block_number, 16))
-        peer_list = backend.get("admin_peers")["result"]
-        logger.info("peerCount: %s" % len(peer_list))
+    myId = nodeId(enode)
+    internal_enode = "%s@%s:30303" % (myId, myIp)
+    key = myId.encode("utf8")
+
+    if legacyRegistration:
+        # Older masters only follow the original topic, adding each unkeyed
+        # enode they see. They dial us as a trusted peer, which connects both
+        # ways, so we don't need to read the topic ourselves.
         try:
-            max_difficulty = max(0, 0, *[
-                p.get("protocols", {}).get("eth", {}).get("difficulty", 0)
-                for p in peer_list
-                if isinstance(p.get("protocols", {}).get("eth"), dict)
+            admin.create_topics([
+                kafka.admin.NewTopic(topic, 1, 3, topic_configs={"compression.type": "gzip"})
             ])
-        except AttributeError:
-            raise ValueError("Got %s" % peer_list)
+        except kafka.errors.TopicAlreadyExistsError:
+            pass
+        producer.send(topic, internal_enode.encode("utf8"))
+
+    def heartbeat():
+        producer.send(registry, key=key, value=json.dumps(
+            {"enode": internal_enode, "ts": time.time()}).encode("utf8"))
+        return time.time()
+
+    lastHeartbeat = heartbeat()
+    logger.info("Registered with %s as %s", registry, internal_enode)
+    peers = PeerRegistry(myId, peerTTL)
+    # While catching up on the topic's history, registrations are collected
+    # across polls and applied once the backlog is drained, so a node that has
+    # registered many times is only dialed at its latest address, and masters
+    # whose heartbeats have lapsed are never dialed at all.
+    backlog = None
+    caughtUp = False
+    records = 0
+    try:
+        while not stop.is_set():
+            # poll() rather than iterating the consumer so a shutdown request
+            # is noticed within POLL_TIMEOUT_MS even when the topic is idle.
+            batch = consumer.poll(timeout_ms=POLL_TIMEOUT_MS,
+                                  max_records=POLL_MAX_RECORDS)
+            for msgs in batch.values():
+                for msg in msgs:
+                    peers.observe(msg)
+                    records += 1
+            if time.time() - lastHeartbeat >= heartbeatInterval:
+                lastHeartbeat = heartbeat()
+            if not caughtUp:
+                partitions = consumer.assignment()
+                if not partitions:
+                    continue
+                if backlog is None:
+                    backlog = consumer.end_offsets(list(partitions))
+                    logger.info("Catching up on %s: %s records in backlog", registry, records + sum(
+                        offset - consumer.position(tp) for tp, offset in backlog.items()))
+                if any(consumer.position(tp) < offset for tp, offset in backlog.items()):
+                    continue
+            added, removed = peers.apply(backend)
+            # Tombstone long dead masters, or the compacted registry would keep
+            # their last heartbeat forever.
+            for id in peers.expired():
+                producer.send(registry, key=id.encode("utf8"), value=None)
+            if not caughtUp:
+                caughtUp = True
+                logger.info("Caught up on %s in %.1fs: %s records, %s peers, %s added",
+                            registry, time.time() - start, records, len(peers.peers), added)
+    finally:
+        # A tombstone lets the other masters drop us straight away rather than
+        # waiting out the TTL.
+        producer.send(registry, key=key, value=None)
+        consumer.close()
+        producer.close(timeout=SHUTDOWN_TIMEOUT)
+        admin.close()
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class PeerScorer(object):
+    """
+    Scores external peers on how well they keep up with the chain. Each poll of
+    admin_peers records, per peer, its total difficulty alongside the best total
+    difficulty of any peer, in a ring buffer of the last PEER_HISTORY polls. A
+    peer's score is the average of:
+
+    - the fraction of those polls in which it was at the head, and
+    - its head progress rate: how far its total difficulty advanced over the
+      window relative to how far the best total difficulty advanced.
+
+    Peers that disconnect are forgotten, so memory is bounded by the number of
+    connected peers. Trusted and static peers (our other masters) are never
+    scored or evicted.
+    """
+    def __init__(self, maxPeers=MAX_PEERS, historySize=PEER_HISTORY):
+        self.maxPeers = maxPeers
+        self.historySize = historySize
+        self.history = {}
+        self.scores = {}
+        self.best = 0
+
+    def observe(self, peer_list, now=None):
+        if now is None:
+            now = time.time()
+        observations = {}
         for peer in peer_list:
-            enode = peer["enode"]
-            try:
-                peer_difficulty = peer["protocols"]["eth"]["difficulty"]
-            except TypeError:
-                peer_difficulty = 0
-            clean_record = {"count": 0, "difficulty": peer_difficulty}
-            peers.setdefault(enode, clean_record)
-            if peer_difficulty < (max_difficulty * 0.9999):
-                if peers[enode]["difficulty"] < peer_difficulty:
-                    peers[enode] = clean_record
-                else:
-                    peers[enode]["count"] += 1
-                if peers[enode]["count"] > 10:
-                    if backend.get("admin_removePeer", [enode])["result"]:
-                        logger.info(
-                            "Dropped %s for lack of progress", enode)
-                        del peers[enode]
-                    else:
-                        logger.info("Failed to remove peer: %s", enode)
-        time.sleep(20)
+            network = peer.get("network", {})
+            if network.get("trusted") or network.get("static"):
+                continue
+            eth = peer.get("protocols", {}).get("eth")
+            difficulty = eth.get("difficulty", 0) if isinstance(eth, dict) else 0
+            observations[peer["enode"]] = difficulty or 0
+        best = max([0] + list(observations.values()))
+        self.best = best
+        for enode in list(self.history):
+            if enode not in observations:
+                del self.history[enode]
+        for enode, difficulty in observations.items():
+            if enode not in self.history:
+                self.history[enode] = collections.deque(maxlen=self.historySize)
+            self.history[enode].append((now, difficulty, best))
+        self.scores = dict((enode, self.score(history))
+                           for enode, history in self.history.items())
+
+    def score(self, history):
+        atHead = sum(1 for _, difficulty, best in history
+                     if difficulty >= best * HEAD_TOLERANCE)
+        _, firstDifficulty, firstBest = history[0]
+        _, lastDifficulty, lastBest = history[-1]
+        if lastBest > firstBest:
+            progress = (lastDifficulty - firstDifficulty) / float(lastBest - firstBest)
+            progress = min(1.0, max(0.0, progress))
+        else:
+            progress = 1.0
+        return (atHead / float(len(history)) + progress) / 2
+
+    def stalled(self, history):
+        if len(history) < STALL_OBSERVATIONS:
+            return False
+        recent = list(history)[-STALL_OBSERVATIONS:]
+        return (recent[-1][1] <= recent[0][1] and
+                all(difficulty < best * HEAD_TOLERANCE for _, difficulty, best in recent))
+
+    def evictions(self):
+        """
+        Returns the peers to drop: any that have stalled behind the head, and,
+        when within EVICTION_HEADROOM of maxPeers, the worst scoring peers below
+        EVICTION_SCORE.
+        """
+        drop = [enode for enode, history in self.history.items() if self.stalled(history)]
+        excess = len(self.history) - len(drop) - (self.maxPeers - EVICTION_HEADROOM)
+        if excess > 0:
+            candidates = sorted(
+                (score, enode) for enode, score in self.scores.items()
+                if score < EVICTION_SCORE and enode not in drop and
+                len(self.history[enode]) >= MIN_OBSERVATIONS)
+            drop.extend(enode for _, enode in candidates[:min(excess, MAX_EVICTIONS)])
+        return drop
+
+    def forget(self, enode):
+        self.history.pop(enode, None)
+        self.scores.pop(enode, None)
+
+    def summary(self, evicted):
+        line = "peerScores: peersTracked=%s peersEvicted=%s" % (len(self.scores), evicted)
+        if self.scores:
+            line += " worstPeerScore=%.3f medianPeerScore=%.3f" % (
+                min(self.scores.values()), median(self.scores.values()))
+        return line
+
+
+def waitForHead(heads, stop, timeout):
+    """Waits up to timeout for a new head, returning early on shutdown"""
+    deadline = time.time() + timeout
+    while not stop.is_set():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        if heads.wait(min(1, remaining)):
+            return True
+    return False
+
+
+def externalPeerManager(backend, stop, maxPeers=MAX_PEERS, telemetry=False):
+    scorer = PeerScorer(maxPeers)
+    heads = threading.Event()
+    try:
+        backend.subscribe(lambda head: heads.set(), "newHeads")
+        subscribed = True
+    except IPCError as e:
+        logger.warning("Could not subscribe to new heads, polling every %ss: %s",
+                       SYNCED_INTERVAL, e)
+        subscribed = False
+    behind = None
+    while not stop.is_set():
+        heads.clear()
+        block_number, syncing, peer_list, node_info = [
+            response["result"] for response in backend.batch([
+                ("eth_blockNumber", []),
+                ("eth_syncing", []),
+                ("admin_peers", []),
+                ("admin_nodeInfo", []),
+            ])
+        ]
+        if not telemetry:
+            # Otherwise nodeTelemetry reports these
+            logger.info("blockNumber: %s" % int(block_number, 16))
+            logger.info("peerCount: %s" % len(peer_list))
+        scorer.observe(peer_list)
+        drop = scorer.evictions()
+        evicted = 0
+        responses = backend.batch([("admin_removePeer", [enode]) for enode in drop])
+        for enode, response in zip(drop, responses):
+            if response.get("result"):
+                logger.info("Dropped %s with score %.3f", enode, scorer.scores[enode])
+                scorer.forget(enode)
+                evicted += 1
+            else:
+                logger.info("Failed to remove peer: %s", enode)
+        logger.info(scorer.summary(evicted))
+
+        eth = node_info.get("protocols", {}).get("eth")
+        difficulty = eth.get("difficulty", 0) if isinstance(eth, dict) else 0
+        wasBehind = behind
+        behind = bool(syncing) or difficulty < scorer.best * HEAD_TOLERANCE
+        if behind != wasBehind:
+            if behind:
+                logger.info("Behind the best peer, checking peers every %ss", BEHIND_INTERVAL)
+            else:
+                logger.info("Synced, checking peers on new heads")
+        if behind:
+            stop.wait(BEHIND_INTERVAL)
+        else:
+            # Heads arriving during the minimum interval still trigger a check
+            # as soon as it's over.
+            stop.wait(SYNCED_INTERVAL)
+            if subscribed:
+                waitForHead(heads, stop, IDLE_INTERVAL - SYNCED_INTERVAL)
+
+
+def quantity(value):
+    """
+    Decodes a JSON-RPC quantity, which geth sends as hex or as a number. Anything
+    else decodes to None.
+    """
+    if isinstance(value, bool):
+        return None
+    try:
+        if isinstance(value, six.string_types):
+            return int(value, 16)
+        if isinstance(value, six.integer_types + (float,)):
+            return int(value)
+    except ValueError:
+        pass
+    return None
+
+
+def mapping(value):
+    return value if isinstance(value, dict) else {}
+
+
+TELEMETRY_CALLS = [
+    ("net_peerCount", []),
+    ("eth_syncing", []),
+    ("eth_getBlockByNumber", ["latest", False]),
+    ("txpool_status", []),
+    ("debug_dbAncients", []),
+]
+
+
+def telemetryRecord(results, now):
+    """
+    Builds the telemetry document from the results of TELEMETRY_CALLS, by
+    method. Every field is always present, and null when geth didn't provide
+    it or sent something unexpected:
+
+    - v: TELEMETRY_SCHEMA, bumped if a field changes meaning
+    - peerCount: connected peers
+    - syncing: whether geth is syncing
+    - syncLag: blocks between the head and the highest known block
+    - headNumber, headTimestamp: the latest block
+    - headAge: seconds since the latest block's timestamp
+    - txpoolPending, txpoolQueued: transactions in the pool
+    - freezerBlocks: blocks moved to the ancient store
+    """
+    syncing = results.get("eth_syncing")
+    head = mapping(results.get("eth_getBlockByNumber"))
+    txpool = mapping(results.get("txpool_status"))
+    headNumber = quantity(head.get("number"))
+    headTimestamp = quantity(head.get("timestamp"))
+    syncLag = None
+    if syncing:
+        highest = quantity(mapping(syncing).get("highestBlock"))
+        current = quantity(mapping(syncing).get("currentBlock"))
+        if highest is not None and current is not None:
+            syncLag = max(0, highest - current)
+    elif "eth_syncing" in results:
+        syncLag = 0
+    return {
+        "v": TELEMETRY_SCHEMA,
+        "peerCount": quantity(results.get("net_peerCount")),
+        "syncing": bool(syncing) if "eth_syncing" in results else None,
+        "syncLag": syncLag,
+        "headNumber": headNumber,
+        "headTimestamp": headTimestamp,
+        "headAge": round(max(0, now - headTimestamp), 1) if headTimestamp is not None else None,
+        "txpoolPending": quantity(txpool.get("pending")),
+        "txpoolQueued": quantity(txpool.get("queued")),
+        "freezerBlocks": quantity(results.get("debug_dbAncients")),
+    }
+
+
+def nodeTelemetry(backend, stop, interval=TELEMETRY_INTERVAL):
+    """
+    Every interval seconds, fetches TELEMETRY_CALLS in one batch and logs them
+    as a "telemetry: " line with a JSON document (see telemetryRecord) that
+    logMonitor decodes without regexes. Methods geth doesn't offer, such as
+    debug_dbAncients on older versions, are dropped from later batches.
+    Telemetry is best effort: a failed sample is logged and skipped rather than
+    stopping the peer managers.
+    """
+    calls = list(TELEMETRY_CALLS)
+    while not stop.is_set():
+        start = time.time()
+        try:
+            results = {}
+            unavailable = []
+            for call, response in zip(calls, backend.batch(calls)):
+                if "error" in response:
+                    if response["error"].get("code") == -32601:
+                        logger.info("%s unavailable, leaving it out of telemetry", call[0])
+                        unavailable.append(call)
+                    continue
+                results[call[0]] = response.get("result")
+            for call in unavailable:
+                calls.remove(call)
+            logger.info("telemetry: %s" % json.dumps(
+                telemetryRecord(results, time.time()), sort_keys=True, separators=(",", ":")))
+        except Exception as e:
+            if stop.is_set():
+                return
+            logger.warning("Telemetry sample failed: %s", e)
+        stop.wait(max(0, interval - (time.time() - start)))
+
+
+class PeerManager(object):
+    """
+    Runs the trusted peer, external peer and telemetry loops as threads of a
+    single process sharing one IPC connection. The first loop to fail, or a SIGTERM /
+    SIGINT, sets the shared stop event; every loop notices it within a second
+    or POLL_TIMEOUT_MS and winds down, after which the IPC connection is
+    closed.
+    """
+    def __init__(self, path, broker_config, topic,
+                 heartbeatInterval=HEARTBEAT_INTERVAL, peerTTL=PEER_TTL,
+                 maxPeers=MAX_PEERS, telemetryInterval=TELEMETRY_INTERVAL,
+                 legacyRegistration=True):
+        self.backend = IPCBackend(path)
+        self.stop = threading.Event()
+        self.failed = False
+        self.threads = [
+            threading.Thread(
+                target=self.supervise,
+                args=(trustedPeerManager, self.backend, broker_config, topic, self.stop,
+                      heartbeatInterval, peerTTL, legacyRegistration),
+                name="trustedPeerManager"),
+            threading.Thread(
+                target=self.supervise,
+                args=(externalPeerManager, self.backend, self.stop, maxPeers,
+                      bool(telemetryInterval)),
+                name="externalPeerManager"),
+        ]
+        if telemetryInterval:
+            self.threads.append(threading.Thread(
+                target=self.supervise,
+                args=(nodeTelemetry, self.backend, self.stop, telemetryInterval),
+                name="nodeTelemetry"))
+
+    def supervise(self, target, *args):
+        try:
+            target(*args)
+        except Exception:
+            if not self.stop.is_set():
+                logger.exception("%s failed", target.__name__)
+                self.failed = True
+        self.stop.set()
+
+    def shutdown(self, signum=None, frame=None):
+        if signum is not None:
+            logger.info("Received signal %s, shutting down", signum)
+        self.stop.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        # Wait with a timeout so the main thread stays responsive to signals
+        # under Python 2, where an untimed Event.wait() blocks them.
+        while not self.stop.is_set():
+            self.stop.wait(1)
+        # Closing the backend fails any IPC call still waiting on geth, so the
+        # loops don't hold up shutdown for IPC_TIMEOUT.
+        self.backend.close()
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+        return 1 if self.failed else 0
 
 if __name__ == "__main__":
     import argparse
-    import multiprocessing
     parser = argparse.ArgumentParser()
 
     parser.add_argument("ipc_path")
     parser.add_argument("topic")
     parser.add_argument("broker_url")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL,
+                        help="Seconds between registrations on the registry topic")
+    parser.add_argument("--peer-ttl", type=float, default=PEER_TTL,
+                        help="Seconds without a heartbeat before a peer is removed")
+    parser.add_argument("--maxpeers", type=int, default=MAX_PEERS,
+                        help="geth's --maxpeers, above which low scoring peers are evicted")
+    parser.add_argument("--telemetry-interval", type=float, default=TELEMETRY_INTERVAL,
+                        help="Seconds between telemetry log lines, or 0 to disable them")
+    parser.add_argument("--no-legacy-registration", dest="legacy_registration",
+                        action="store_false",
+                        help="Don't register on <topic> for masters running an older peerManager")
     args = parser.parse_args()
 
     broker_config = {}
@@ -157,21 +961,7 @@ if __name__ == "__main__":
         broker_config["bootstrap_servers"] = hosts.split(",")
         if tls == "tls=1":
             broker_config["security_protocol"] = "SASL_SSL"
-    p1 = multiprocessing.Process(
-        target=trustedPeerManager,
-        args=(args.ipc_path, broker_config, args.topic)
-    )
-    p2 = multiprocessing.Process(
-        target=externalPeerManager,
-        args=(args.ipc_path,)
-    )
-    p1.start()
-    p2.start()
-    while True:
-        if not p1.is_alive():
-            p2.terminate()
-            break
-        if not p2.is_alive():
-            p1.terminate()
-            break
-        time.sleep(0.1)
+    sys.exit(PeerManager(args.ipc_path, broker_config, args.topic,
+                         args.heartbeat_interval, args.peer_ttl,
+                         args.maxpeers, args.telemetry_interval,
+                         args.legacy_registration).run())
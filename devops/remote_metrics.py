@@ -1,24 +1,242 @@
 import os
-import boto3
 import json
-import urllib
+import logging
+import math
+import time
 import datetime
+import http.client
+import socket
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+from awsUtils import MetricPublisher, getClient
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
-client = boto3.client('cloudwatch')
 q = '{"jsonrpc": "2.0", "method": "eth_blockNumber", "params": [], "id": 1}'.encode("utf8")
+latestBlock = '{"jsonrpc": "2.0", "method": "eth_getBlockByNumber", "params": ["latest", false], "id": 1}'.encode("utf8")
+# Our own RPC endpoints, compared against the RPC_URL reference providers
+CLUSTER_RPC_URL = os.environ.get("CLUSTER_RPC_URL", "")
+# Requests sent to each cluster endpoint to measure latency percentiles
+LATENCY_BURST = max(1, int(os.environ.get("LATENCY_BURST", 5)))
+# Seconds to wait on each socket operation, so one slow provider can't hold up
+# the rest
+RPC_TIMEOUT = float(os.environ.get("RPC_TIMEOUT", 5))
+# Seconds of the invocation's time limit kept back to publish whatever the
+# probes have gathered. Probes still running by then are reported as errors.
+PUBLISH_MARGIN = float(os.environ.get("PUBLISH_MARGIN", 2))
+
+# Keep-alive connections by URL, reused while the Lambda container stays warm.
+# Each URL is only probed by one thread at a time.
+connections = {}
+# Each cluster endpoint's head block number and when it was last seen to change,
+# by URL, kept while the container stays warm. On a cold start the head block's
+# timestamp stands in for the time of the last change.
+clusterHeads = {}
+
+
+def getConnection(url, timeout):
+    conn = connections.get(url)
+    if conn is None:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme == "https":
+            conn = http.client.HTTPSConnection(parsed.netloc, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(parsed.netloc, timeout=timeout)
+        connections[url] = conn
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+    return conn
+
+
+def dropConnection(url):
+    """
+    Removes url's connection from the pool and shuts its socket down, failing
+    any request still waiting on it.
+    """
+    conn = connections.pop(url, None)
+    if conn is not None and conn.sock is not None:
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def rpcCall(url, payload, deadline=None):
+    """
+    POSTs a JSON-RPC payload to url over a pooled keep-alive connection and
+    returns the decoded response. Each socket operation waits up to RPC_TIMEOUT,
+    or until deadline if that is sooner. A request on a reused connection that
+    fails is retried once on a fresh connection, as the provider may have closed
+    it while the container was idle.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path or "/"
+    if parsed.query:
+        path += "?" + parsed.query
+    for attempt in range(2):
+        timeout = RPC_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.time())
+            if timeout <= 0:
+                raise TimeoutError("Out of time for %s" % url)
+        conn = getConnection(url, timeout)
+        reused = conn.sock is not None
+        try:
+            conn.request("POST", path, body=payload,
+                         headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if connections.get(url) is conn:
+                del connections[url]
+            if reused and attempt == 0:
+                continue
+            raise
+        if response.status != 200:
+            raise http.client.HTTPException("HTTP %s from %s" % (response.status, url))
+        return json.loads(body.decode("utf8"))
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list"""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def datum(metricName, dimensions, timestamp, value, unit="None"):
+    return {
+        'MetricName': metricName,
+        'Dimensions': dimensions,
+        'Timestamp': timestamp,
+        'Value': value,
+        'Unit': unit,
+    }
+
+
+def probe(url, timestamp, deadline=None):
+    """
+    Returns the metric data for one reference provider's block number and
+    latency, along with the block number (None if the provider failed).
+    """
+    dimensions = [{"Name": "provider", "Value": url}]
+    start = time.time()
+    try:
+        result = int(rpcCall(url, q, deadline)["result"], 16)
+    except Exception as e:
+        logger.warning("Failed to get block number from %s: %s", url, e)
+        return [datum("RemoteRequestError", dimensions, timestamp, 1, "Count")], None
+    latency = (time.time() - start) * 1000
+    return [
+        datum("RemoteBlockNumber", dimensions, timestamp, result),
+        datum("RemoteRequestLatency", dimensions, timestamp, latency, "Milliseconds"),
+    ], result
+
+
+def probeCluster(url, timestamp, deadline=None):
+    """
+    Sends a burst of LATENCY_BURST requests to one of our own endpoints,
+    returning metric data for its latency percentiles and head age (seconds
+    since its head last changed), along with its head block number (None if the
+    endpoint failed). The requests share the deadline, and if one fails the
+    latencies measured before it are still reported, along with an error.
+    """
+    dimensions = [{"Name": "endpoint", "Value": url}]
+    metricData = []
+    latencies = []
+    head = blockTime = None
+    try:
+        for _ in range(LATENCY_BURST):
+            start = time.time()
+            head = int(rpcCall(url, q, deadline)["result"], 16)
+            latencies.append((time.time() - start) * 1000)
+        block = rpcCall(url, latestBlock, deadline)["result"]
+        head = max(head, int(block["number"], 16))
+        blockTime = int(block["timestamp"], 16)
+    except Exception as e:
+        logger.warning("Failed to probe cluster endpoint %s: %s", url, e)
+        metricData.append(datum("ClusterRequestError", dimensions, timestamp, 1, "Count"))
+    if latencies:
+        metricData.append(datum("ClusterLatencyP50", dimensions, timestamp,
+                                percentile(latencies, 50), "Milliseconds"))
+        metricData.append(datum("ClusterLatencyP95", dimensions, timestamp,
+                                percentile(latencies, 95), "Milliseconds"))
+    if head is not None:
+        now = time.time()
+        last = clusterHeads.get(url)
+        if last is None and blockTime is not None:
+            last = (head, blockTime)
+        elif last is not None and head != last[0]:
+            last = (head, now)
+        if last is not None:
+            clusterHeads[url] = last
+            metricData.append(datum("ClusterHeadAge", dimensions, timestamp,
+                                    max(0, now - last[1]), "Seconds"))
+    return metricData, head
+
+
+def unique(urls):
+    seen = set()
+    result = []
+    for url in urls:
+        url = url.strip()
+        if url and url not in seen:
+            seen.add(url)
+            result.append(url)
+    return result
+
+
+def probeDeadline(context):
+    """
+    Time by which every probe must finish, leaving PUBLISH_MARGIN of the
+    invocation's time limit to publish the results.
+    """
+    budget = RPC_TIMEOUT * (LATENCY_BURST + 1)
+    if context is not None:
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000.0 - PUBLISH_MARGIN)
+    return time.time() + max(0, budget)
+
+
+def collect(url, future, done, errorMetric, timestamp, dimension):
+    """Returns a finished probe's result, or an error datum for one still running"""
+    if future in done:
+        return future.result()
+    logger.warning("No result from %s in time", url)
+    # Fail the straggler's request so its thread doesn't outlive the invocation
+    dropConnection(url)
+    return [datum(errorMetric, [{"Name": dimension, "Value": url}], timestamp, 1, "Count")], None
 
 
 def handler(event, context):
-    for url in os.environ["RPC_URL"].split(","):
-        request = urllib.request.Request(url, data=q, headers={"Content-Type": "application/json"})
-        result = json.load(urllib.request.urlopen(request))["result"]
-        client.put_metric_data(
-            Namespace="BlockData",
-            MetricData=[{
-                'MetricName': "RemoteBlockNumber",
-                'Dimensions': [{"Name": "provider", "Value": url}],
-                'Timestamp': datetime.datetime.utcnow(),
-                'Value': int(result, 16),
-                'Unit': "None",
-            }]
-        )
+    deadline = probeDeadline(context)
+    # Probe each URL once, so no two threads share a pooled connection. Our
+    # own endpoints aren't references to measure themselves against.
+    clusterUrls = unique(CLUSTER_RPC_URL.split(","))
+    urls = [url for url in unique(os.environ["RPC_URL"].split(","))
+            if url not in clusterUrls]
+    timestamp = datetime.datetime.utcnow()
+    publisher = MetricPublisher(getClient("cloudwatch"), "BlockData")
+    executor = ThreadPoolExecutor(max_workers=len(urls) + len(clusterUrls))
+    providers = [(url, executor.submit(probe, url, timestamp, deadline)) for url in urls]
+    clusters = [(url, executor.submit(probeCluster, url, timestamp, deadline))
+                for url in clusterUrls]
+    done, _ = wait([future for _, future in providers + clusters],
+                   timeout=max(0, deadline - time.time()))
+    # Publish what finished in time rather than waiting on stragglers
+    executor.shutdown(wait=False)
+    heads = []
+    for url, future in providers:
+        metricData, head = collect(url, future, done, "RemoteRequestError", timestamp, "provider")
+        publisher.extend(metricData)
+        if head is not None:
+            heads.append(head)
+    for url, future in clusters:
+        metricData, head = collect(url, future, done, "ClusterRequestError", timestamp, "endpoint")
+        publisher.extend(metricData)
+        if head is not None and heads:
+            # Positive when our head is behind the furthest ahead provider
+            publisher.append(datum("ClusterHeadLag", [{"Name": "endpoint", "Value": url}],
+                                   timestamp, max(heads) - head))
+    return publisher.flush()
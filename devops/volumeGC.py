@@ -1,44 +1,117 @@
-import boto3
 import os
 import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from awsUtils import callWithBackoff, errorCode, getClient
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Longest to wait for a detached volume to become available before leaving it
+# to a later cleanup. 0 skips waiting, leaving the volume to the EBS Volume
+# Notification the detach triggers. The wait is also cut short to leave
+# CLEANUP_MARGIN seconds of the invocation's time limit for the cleanup itself.
+DETACH_TIMEOUT = float(os.environ.get("DETACH_TIMEOUT", 60))
+CLEANUP_MARGIN = float(os.environ.get("CLEANUP_MARGIN", 10))
+DETACH_POLL_MIN = 0.5
+DETACH_POLL_MAX = 8
+# Concurrent delete_volume calls
+DELETE_WORKERS = int(os.environ.get("DELETE_WORKERS", 8))
+
+
+def detached_volume_ids():
+    paginator = getClient("resourcegroupstaggingapi").get_paginator("get_resources")
+    for page in paginator.paginate(
+            TagFilters=[{"Key": "DELETE_ON_DETACH", "Values": ["True"]}],
+            ResourceTypeFilters=["ec2:volume"]):
+        for mapping in page["ResourceTagMappingList"]:
+            yield mapping["ResourceARN"].split("/")[1]
+
+
+def delete_volume(volume_id):
+    """
+    Returns True if deleted, False if it failed, or None if there was nothing to
+    do yet: the volume is gone already or is still detaching.
+    """
+    try:
+        callWithBackoff(getClient("ec2").delete_volume, VolumeId=volume_id)
+    except Exception as e:
+        if errorCode(e) in ("InvalidVolume.NotFound", "VolumeInUse", "IncorrectState"):
+            # The tagging API lags behind deletions, and volumes are tagged
+            # before they're detached
+            return None
+        logger.info("Could not delete %s: %s", volume_id, e)
+        return False
+    logger.info("Deleted %s", volume_id)
+    return True
 
-ec2Client = boto3.client('ec2')
-taggingClient = boto3.client('resourcegroupstaggingapi')
 
 def cleanup_detached_volumes():
-    res = taggingClient.get_resources(TagFilters=[{"Key": "DELETE_ON_DETACH", "Values": ["True"]}])
-    for mapping in res["ResourceTagMappingList"]:
-        volume_id = mapping["ResourceARN"].split("/")[1]
-        try:
-            ec2Client.delete_volume(VolumeId = volume_id)
-        except Exception:
-            pass
+    """
+    Deletes every volume tagged DELETE_ON_DETACH, over a bounded thread pool.
+    Volumes still attached are left for the next run.
+    """
+    volume_ids = list(detached_volume_ids())
+    result = {"deleted": 0, "failed": 0}
+    if not volume_ids:
+        return result
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        for deleted in executor.map(delete_volume, volume_ids):
+            if deleted:
+                result["deleted"] += 1
+            elif deleted is False:
+                result["failed"] += 1
+    logger.info("Cleaned up detached volumes: %(deleted)s deleted, %(failed)s failed", result)
+    return result
+
+
+def wait_for_available(volume_id, timeout=DETACH_TIMEOUT):
+    """
+    Polls the volume with exponential backoff until it is available, giving up
+    after timeout seconds. Returns whether it became available.
+    """
+    deadline = time.time() + timeout
+    delay = DETACH_POLL_MIN
+    while True:
+        state = getClient("ec2").describe_volumes(VolumeIds=[volume_id])["Volumes"][0]["State"]
+        if state == "available":
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            logger.info("%s still %s after %ss, leaving it for a later cleanup",
+                        volume_id, state, timeout)
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, DETACH_POLL_MAX)
+
 
 def handler(event, context):
+    ec2Client = getClient("ec2")
+    if event.get("detail-type") == "EBS Volume Notification":
+        # The detach has completed; the volume can go if it's one we tagged
+        return cleanup_detached_volumes()
     if event["detail"]["state"] != "pending":
-        cleanup_detached_volumes()  # Run just in case something got missed previously
-        return
+        return cleanup_detached_volumes()  # Run just in case something got missed previously
     instance_details = ec2Client.describe_instances(InstanceIds=[event["detail"]["instance-id"]])
     instance_type = instance_details["Reservations"][0]["Instances"][0]["InstanceType"]
     family, size = instance_type.split(".")
     if not family.endswith("d"):
-        cleanup_detached_volumes()  # Run just in case something got missed previously
-        return
+        return cleanup_detached_volumes()  # Run just in case something got missed previously
     tags = {i["Key"]: i["Value"] for i in instance_details["Reservations"][0]["Instances"][0]["Tags"]}
     if tags.get(os.environ.get("TAG_NAME", "VOLUME_MGMT_GROUP")) != os.environ.get("TAG_VALUE", "X"):
-        cleanup_detached_volumes()  # Run just in case something got missed previously
-        return
+        return cleanup_detached_volumes()  # Run just in case something got missed previously
     volumes = {a["DeviceName"]: a["Ebs"]["VolumeId"] for a in instance_details["Reservations"][0]["Instances"][0]["BlockDeviceMappings"]}
     if os.environ["VOLUME_NAME"] not in volumes:
-        cleanup_detached_volumes()  # Last attempt probably timed out
-        return
-    # TODO: Tag volume, detach volume, subsequent event will watch for detach transition and delete
+        return cleanup_detached_volumes()  # Last attempt probably timed out
     ec2Client.create_tags(Resources=[volumes[os.environ["VOLUME_NAME"]]], Tags=[{"Key": "DELETE_ON_DETACH", "Value": "True"}])
     ec2Client.detach_volume(
         Device=os.environ["VOLUME_NAME"],
         InstanceId=event["detail"]["instance-id"],
         VolumeId=volumes[os.environ["VOLUME_NAME"]],
     )
-    while ec2Client.describe_volumes(VolumeIds=[volumes[os.environ["VOLUME_NAME"]]])["Volumes"][0]["State"] != "available":
-        time.sleep(0.5)
-    cleanup_detached_volumes()
+    timeout = DETACH_TIMEOUT
+    if context is not None:
+        timeout = min(timeout, context.get_remaining_time_in_millis() / 1000.0 - CLEANUP_MARGIN)
+    if timeout > 0:
+        wait_for_available(volumes[os.environ["VOLUME_NAME"]], timeout)
+    return cleanup_detached_volumes()
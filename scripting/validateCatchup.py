@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+"""
+Checks that a freshly started geth can import blocks from the network.
+
+geth is sampled over a single keep-alive HTTP connection, one JSON-RPC batch of
+the latest block and eth_syncing per --interval. From those samples it tracks
+an exponentially smoothed import rate, both in blocks per second and in chain
+seconds per second, and estimates how long until the node reaches the network
+head.
+
+Validation passes once at least --min-blocks blocks have been imported and the
+node has either caught up (within --max-lag blocks of the highest known block,
+with a head no older than --max-head-age) or has sustained --min-rate blocks per
+second for a full smoothing window. It fails if geth exits, if no block is
+imported for --stall-timeout seconds, or if neither happens within --timeout.
+A JSON report is printed to stdout either way, and the exit status is 0 on a
+pass and 1 on a failure.
+"""
+
+import argparse
+import errno
+import json
+import logging
+import math
+import os
+import socket
+import sys
+import time
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RPC_TIMEOUT = 10
+PROGRESS_INTERVAL = 30
+
+
+class RPCError(Exception):
+    pass
+
+
+class RPCClient(object):
+    """
+    JSON-RPC batches over one keep-alive HTTP connection, reopened if geth
+    closes it or isn't listening yet.
+    """
+    def __init__(self, host, port, timeout=RPC_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+        self.requests = 0
+
+    def batch(self, calls):
+        payload = json.dumps([
+            {"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+            for i, (method, params) in enumerate(calls)
+        ])
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.conn.request("POST", "/", payload, {"Content-Type": "application/json"})
+            response = self.conn.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException) as e:
+            self.close()
+            raise RPCError("%s:%s: %s" % (self.host, self.port, e))
+        self.requests += 1
+        if response.status != 200:
+            raise RPCError("HTTP %s from %s:%s" % (response.status, self.host, self.port))
+        results = {}
+        for item in json.loads(body.decode("utf8")):
+            if "error" in item:
+                raise RPCError("%s failed: %s" % (calls[item["id"]][0], item["error"]))
+            results[item["id"]] = item["result"]
+        return [results.get(i) for i in range(len(calls))]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Sample(object):
+    def __init__(self, t, number, timestamp, highest, syncing):
+        self.t = t
+        self.number = number
+        self.timestamp = timestamp
+        self.highest = highest
+        self.syncing = syncing
+
+    @property
+    def lag(self):
+        """Blocks behind the highest block geth knows of"""
+        return max(0, self.highest - self.number)
+
+    @property
+    def headAge(self):
+        return max(0, self.t - self.timestamp)
+
+
+def sample(client):
+    block, syncing = client.batch([
+        ("eth_getBlockByNumber", ["latest", False]),
+        ("eth_syncing", []),
+    ])
+    number = int(block["number"], 16)
+    highest = int(syncing["highestBlock"], 16) if syncing else number
+    return Sample(time.time(), number, int(block["timestamp"], 16), highest, bool(syncing))
+
+
+class RateTracker(object):
+    """
+    Exponentially weighted rate of change of a counter, weighted by the time
+    between samples so irregular sampling doesn't skew it. `window` is the time
+    constant in seconds.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.rate = None
+        self.last = None
+
+    def update(self, t, value):
+        if self.last is not None and t > self.last[0]:
+            dt = t - self.last[0]
+            instant = (value - self.last[1]) / float(dt)
+            if self.rate is None:
+                self.rate = instant
+            else:
+                self.rate += (1 - math.exp(-dt / self.window)) * (instant - self.rate)
+        self.last = (t, value)
+        return self.rate
+
+
+def running(pid):
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def eta(latest, blockRate, chainRate):
+    """
+    Seconds until the node reaches the network head: from the known block lag
+    while geth reports syncing, otherwise from how fast chain time is gaining on
+    wall clock time. None if it isn't gaining.
+    """
+    if latest.lag:
+        return latest.lag / blockRate if blockRate and blockRate > 0 else None
+    if chainRate is not None and chainRate > 1:
+        return latest.headAge / (chainRate - 1)
+    return None
+
+
+def validate(client, args):
+    start = time.time()
+    deadline = start + args.timeout
+    blocks = RateTracker(args.window)
+    chain = RateTracker(args.window)
+    report = {
+        "passed": False,
+        "thresholds": {
+            "minBlocks": args.min_blocks,
+            "minRate": args.min_rate,
+            "maxLag": args.max_lag,
+            "maxHeadAge": args.max_head_age,
+            "timeout": args.timeout,
+            "stallTimeout": args.stall_timeout,
+        },
+        "samples": 0,
+        "rpcErrors": 0,
+    }
+
+    def finish(passed, reason):
+        report["passed"] = passed
+        report["reason"] = reason
+        report["elapsedSeconds"] = round(time.time() - start, 3)
+        report["rpcRequests"] = client.requests
+        return report
+
+    first = latest = None
+    lastProgress = lastImport = start
+    while True:
+        if not running(args.pid):
+            return finish(False, "geth (pid %s) exited" % args.pid)
+        try:
+            current = sample(client)
+        except (RPCError, KeyError, TypeError, ValueError) as e:
+            if first is not None:
+                report["rpcErrors"] += 1
+                logger.info("Sample failed: %s", e)
+            current = None
+        if current is not None:
+            report["samples"] += 1
+            if first is None:
+                first = current
+                lastImport = current.t
+                report["rpcReadySeconds"] = round(current.t - start, 3)
+                report["startBlock"] = first.number
+                logger.info("RPC available after %.1fs at block %s", current.t - start, first.number)
+            elif current.number > latest.number:
+                lastImport = current.t
+            latest = current
+            blockRate = blocks.update(current.t, current.number)
+            chainRate = chain.update(current.t, current.timestamp)
+            imported = latest.number - first.number
+            remaining = eta(latest, blockRate, chainRate)
+            report.update({
+                "headBlock": latest.number,
+                "highestBlock": latest.highest,
+                "blocksImported": imported,
+                "importRate": round(blockRate, 3) if blockRate is not None else None,
+                "chainSecondsPerSecond": round(chainRate, 3) if chainRate is not None else None,
+                "lagBlocks": latest.lag,
+                "headAgeSeconds": round(latest.headAge, 1),
+                "syncing": latest.syncing,
+                "etaSeconds": round(remaining) if remaining is not None else None,
+            })
+            if imported >= args.min_blocks:
+                if latest.lag <= args.max_lag and latest.headAge <= args.max_head_age:
+                    return finish(True, "caught up at block %s" % latest.number)
+                if (blockRate is not None and blockRate >= args.min_rate and
+                        latest.t - first.t >= args.window):
+                    return finish(True, "importing %.2f blocks/s" % blockRate)
+            if time.time() - lastProgress >= PROGRESS_INTERVAL:
+                lastProgress = time.time()
+                logger.info("Block %s, %s imported, %s blocks/s, %s behind, head %.0fs old, eta %ss",
+                            latest.number, imported, report["importRate"], latest.lag,
+                            latest.headAge, report["etaSeconds"])
+        now = time.time()
+        if first is not None and now - lastImport >= args.stall_timeout:
+            return finish(False, "no blocks imported in %ss" % args.stall_timeout)
+        if now >= deadline:
+            if first is None:
+                return finish(False, "RPC unavailable after %ss" % args.timeout)
+            return finish(False, "timed out after %ss" % args.timeout)
+        time.sleep(max(0, min(args.interval, deadline - now)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rpc", default="localhost:8545",
+                        help="host:port of geth's HTTP RPC")
+    parser.add_argument("--pid", type=int,
+                        help="geth's process ID, to fail as soon as it exits")
+    parser.add_argument("--interval", type=float, default=1,
+                        help="Seconds between samples")
+    parser.add_argument("--window", type=float, default=15,
+                        help="Time constant of the smoothed rates, in seconds")
+    parser.add_argument("--min-blocks", type=int, default=10,
+                        help="Blocks that must be imported to pass")
+    parser.add_argument("--min-rate", type=float, default=1,
+                        help="Smoothed blocks per second that pass while still behind")
+    parser.add_argument("--max-lag", type=int, default=2,
+                        help="Blocks behind the highest known block that count as caught up")
+    parser.add_argument("--max-head-age", type=float, default=120,
+                        help="Age in seconds of the head block that counts as caught up")
+    parser.add_argument("--stall-timeout", type=float, default=300,
+                        help="Seconds without importing a block before failing")
+    parser.add_argument("--timeout", type=float, default=1800,
+                        help="Seconds before failing, including waiting for RPC")
+    args = parser.parse_args()
+
+    host, _, port = args.rpc.rpartition(":")
+    client = RPCClient(host or "localhost", int(port))
+    try:
+        report = validate(client, args)
+    finally:
+        client.close()
+    logger.info("Validation %s: %s", "passed" if report["passed"] else "failed", report["reason"])
+    print(json.dumps(report, sort_keys=True))
+    sys.exit(0 if report["passed"] else 1)